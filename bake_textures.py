@@ -0,0 +1,208 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+from PIL import Image
+
+from main import (
+    BAKED_TEXTURE_HEADER, BAKED_TEXTURE_LEVEL, BAKED_TEXTURE_MAGIC, BAKED_TEXTURE_VERSION,
+    TEXTURE_FORMATS, baked_texture_path, packed_material_path
+)
+
+FORMAT_IDS = {name: format for format, (name, _, _, _) in TEXTURE_FORMATS.items()}
+
+#карты, в которых важен один канал (серые)
+GRAYSCALE_MAPS = ("_AO", "_GLOSS")
+
+#карты высот, которые можно положить в третий канал упакованной текстуры
+HEIGHT_MAPS = ("_HEIGHT", "_DISP")
+
+#цепочка mip-уровней до 1x1; размеры уровней как у opengl - max(1, n // 2)
+def build_mip_chain(pixels):
+    levels = [pixels]
+    while pixels.shape[0] > 1 or pixels.shape[1] > 1:
+        size = (max(1, pixels.shape[1] // 2), max(1, pixels.shape[0] // 2))
+        channels = [
+            np.asarray(Image.fromarray(pixels[:, :, c], mode="F").resize(size, Image.BOX))
+            for c in range(pixels.shape[2])
+        ]
+        pixels = np.stack(channels, axis=2)
+        levels.append(pixels)
+    return levels
+
+#разбиение на блоки 4x4 (края дополняются повтором): (число блоков, 16, каналы)
+def split_blocks(pixels):
+    h, w, c = pixels.shape
+    pixels = np.pad(pixels, ((0, -h % 4), (0, -w % 4), (0, 0)), mode="edge")
+    bh, bw = pixels.shape[0] // 4, pixels.shape[1] // 4
+    return pixels.reshape(bh, 4, bw, 4, c).transpose(0, 2, 1, 3, 4).reshape(-1, 16, c)
+
+def to_rgb565(color):
+    color = np.clip(np.rint(color), 0, 255).astype(np.uint32)
+    return ((color[:, 0] >> 3) << 11) | ((color[:, 1] >> 2) << 5) | (color[:, 2] >> 3)
+
+def from_rgb565(packed):
+    r = (packed >> 11) & 31
+    g = (packed >> 5) & 63
+    b = packed & 31
+    return np.stack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)), axis=1).astype(np.float32)
+
+#BC1: два цвета RGB565 по границам блока и 2-битные индексы ближайшего из 4 цветов
+def encode_bc1(blocks):
+    rgb = blocks[:, :, :3]
+    c0 = to_rgb565(rgb.max(axis=1))
+    c1 = to_rgb565(rgb.min(axis=1))
+    swap = c0 < c1
+    c0[swap], c1[swap] = c1[swap], c0[swap]
+
+    p0 = from_rgb565(c0)
+    p1 = from_rgb565(c1)
+    palette = np.stack((p0, p1, (2 * p0 + p1) / 3, (p0 + 2 * p1) / 3), axis=1)
+    distance = ((rgb[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=-1)
+    indices = distance.argmin(axis=-1).astype(np.uint32)
+    indices[c0 == c1] = 0
+
+    out = np.empty(len(blocks), dtype=[("c0", "<u2"), ("c1", "<u2"), ("indices", "<u4")])
+    out["c0"] = c0
+    out["c1"] = c1
+    out["indices"] = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+    return out.tobytes()
+
+#BC4: один канал, два опорных значения и 3-битные индексы из 8 значений
+def encode_bc4(values):
+    r0 = np.clip(np.rint(values.max(axis=1)), 0, 255).astype(np.uint8)
+    r1 = np.clip(np.rint(values.min(axis=1)), 0, 255).astype(np.uint8)
+
+    a = r0.astype(np.float32)[:, None]
+    b = r1.astype(np.float32)[:, None]
+    steps = np.arange(1, 7, dtype=np.float32)
+    palette = np.concatenate((a, b, ((7 - steps) * a + steps * b) / 7), axis=1)
+    indices = np.abs(values[:, :, None] - palette[:, None, :]).argmin(axis=-1).astype(np.uint64)
+    indices[r0 == r1] = 0
+    bits = (indices << (3 * np.arange(16, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+
+    out = np.empty((len(values), 8), dtype=np.uint8)
+    out[:, 0] = r0
+    out[:, 1] = r1
+    out[:, 2:] = bits.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+def encode_level(pixels, format):
+    name = TEXTURE_FORMATS[format][0]
+    if name in ("RGBA8", "R8", "RG8"):
+        return np.clip(np.rint(pixels), 0, 255).astype(np.uint8).tobytes()
+
+    blocks = split_blocks(pixels)
+    if name == "BC1":
+        return encode_bc1(blocks)
+    if name == "BC3":
+        alpha = encode_bc4(blocks[:, :, 3])
+        color = np.frombuffer(encode_bc1(blocks), dtype=np.uint8).reshape(-1, 8)
+        return np.concatenate((alpha, color), axis=1).tobytes()
+    if name == "BC4":
+        return encode_bc4(blocks[:, :, 0]).tobytes()
+    return np.concatenate((encode_bc4(blocks[:, :, 0]), encode_bc4(blocks[:, :, 1])), axis=1).tobytes()
+
+#выбор формата: серые карты - 1 канал, остальные RGBA; со сжатием - соответствующий BC
+def choose_format(filepath, img, compress, pack):
+    grayscale = pack and os.path.splitext(filepath)[0].endswith(GRAYSCALE_MAPS)
+    if grayscale:
+        return FORMAT_IDS["BC4" if compress else "R8"]
+    if not compress:
+        return FORMAT_IDS["RGBA8"]
+    opaque = img.mode not in ("RGBA", "LA", "PA") or img.getchannel("A").getextrema()[0] == 255
+    return FORMAT_IDS["BC1" if opaque else "BC3"]
+
+def bake(filepath, compress, pack):
+    with Image.open(filepath, mode='r') as img:
+        format = choose_format(filepath, img, compress, pack)
+        channels = TEXTURE_FORMATS[format][3]
+        img = img.convert({1: "L", 2: "LA", 4: "RGBA"}[channels])
+        pixels = np.asarray(img, dtype=np.float32).reshape(img.size[1], img.size[0], channels)
+
+    return write_baked(baked_texture_path(filepath), pixels, format)
+
+def find_map(directory, filename, suffixes):
+    for suffix in suffixes:
+        for path in sorted(glob.glob(os.path.join(directory, f"{filename}{suffix}.*"))):
+            if not path.endswith(".btex"):
+                return path
+    return None
+
+def read_gray(filepath, size=None):
+    with Image.open(filepath, mode='r') as img:
+        img = img.convert("L")
+        if size is not None and img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        return np.asarray(img, dtype=np.float32)
+
+#упаковка серых карт материала в одну текстуру: R - ao, G - блики, B - высота (если есть)
+#без карты высот - два канала (RG8 / BC5), с ней - RGBA (RGBA8 / BC1)
+def bake_packed_material(directory, compress):
+    filename = os.path.basename(os.path.normpath(directory))
+    aoPath = find_map(directory, filename, ("_AO",))
+    glossPath = find_map(directory, filename, ("_GLOSS",))
+    if aoPath is None or glossPath is None:
+        return None
+
+    ao = read_gray(aoPath)
+    size = (ao.shape[1], ao.shape[0])
+    channels = [ao, read_gray(glossPath, size)]
+
+    heightPath = find_map(directory, filename, HEIGHT_MAPS)
+    if heightPath is not None:
+        channels += [read_gray(heightPath, size), np.full_like(ao, 255)]
+        format = FORMAT_IDS["BC1" if compress else "RGBA8"]
+    else:
+        format = FORMAT_IDS["BC5" if compress else "RG8"]
+
+    outPath = os.path.join(directory, os.path.basename(packed_material_path(filename)))
+    return write_baked(outPath, np.stack(channels, axis=2), format)
+
+def write_baked(outPath, pixels, format):
+    levels = build_mip_chain(pixels)
+    #запись во временный файл и подмена - прерванное запекание не оставляет оборванный "свежий" .btex
+    tmpPath = outPath + ".tmp"
+    with open(tmpPath, 'wb') as file:
+        file.write(BAKED_TEXTURE_HEADER.pack(
+            BAKED_TEXTURE_MAGIC, BAKED_TEXTURE_VERSION, format, levels[0].shape[1], levels[0].shape[0], len(levels)))
+        for level in levels:
+            data = encode_level(level, format)
+            file.write(BAKED_TEXTURE_LEVEL.pack(level.shape[1], level.shape[0], len(data)))
+            file.write(data)
+    os.replace(tmpPath, outPath)
+
+    return (outPath, TEXTURE_FORMATS[format][0], os.path.getsize(outPath), pixels.shape[0] * pixels.shape[1] * 4 * 4 // 3)
+
+#офлайн-конвертер текстур материалов в .btex: полная mip-цепочка, упаковка серых карт,
+#по желанию блочное сжатие (BC1/BC3 для цвета, BC4/BC5 для одного/двух каналов)
+def main():
+    parser = argparse.ArgumentParser(description="Bake material textures into pre-mipmapped .btex files.")
+    parser.add_argument("files", nargs="*", help="source images (default: gfx/*/*)")
+    parser.add_argument("--compress", action="store_true", help="use GPU block compression")
+    parser.add_argument("--no-pack", dest="pack", action="store_false", help="keep AO/GLOSS maps as RGBA")
+    parser.add_argument("--materials", action="store_true",
+                        help="write one packed AO/GLOSS(/HEIGHT) texture per material directory instead")
+    args = parser.parse_args()
+
+    if args.materials:
+        for directory in args.files or sorted(glob.glob("gfx/*/")):
+            result = bake_packed_material(directory, args.compress)
+            if result is None:
+                print(f"{directory}: no AO/GLOSS maps, skipped")
+            else:
+                report(*result)
+        return
+
+    files = args.files or sorted(
+        path for path in glob.glob("gfx/*/*") if not path.endswith(".btex")
+    )
+    for filepath in files:
+        report(*bake(filepath, args.compress, args.pack))
+
+def report(outPath, name, size, rawSize):
+    print(f"{outPath}: {name}, {size / 1024:.0f} KiB (RGBA8 with mips: {rawSize / 1024:.0f} KiB)")
+
+if __name__ == "__main__":
+    main()
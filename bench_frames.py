@@ -0,0 +1,159 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+from render_headless import create_headless_context, destroy_headless_context, parse_size, select_platform
+
+PERCENTILES = (50, 95, 99)
+
+#метрики с p95 базового прогона ниже порога (мс) не проверяются - у почти пустых участков
+#относительный разброс между прогонами больше любого разумного порога
+MIN_COMPARE_MS = 0.5
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary["mean"] = float(values.mean())
+    summary["max"] = float(values.max())
+    return summary
+
+#один прогон: прогрев, затем frames кадров по пути камеры; на кадр - время cpu на render(),
+#полное время кадра (до glFinish), время проходов на cpu и gpu и счётчики кадра
+def run(args):
+    from OpenGL.GL import GL_RENDERER, GL_VERSION, glFinish, glGetString
+    from main import SCREEN_HEIGHT, SCREEN_WIDTH, CameraPath, FrameProfiler, GraphicsEngine, OffscreenTarget, Scene
+
+    width, height = args.size or (SCREEN_WIDTH * 2, SCREEN_HEIGHT * 2)
+    handles = create_headless_context(args.platform, width, height)
+
+    renderer = GraphicsEngine(renderScale=args.scale, depthPrepass=args.depth_prepass)
+    scene = Scene()
+    target = OffscreenTarget(width, height)
+    renderer.setRenderTarget(target.fbo, width, height)
+    path = CameraPath.load(args.path) if args.path else CameraPath.orbit(args.frames)
+    profiler = FrameProfiler(traceFrames=args.frames)
+    renderer.profiler = profiler
+
+    for frame in range(args.warmup):
+        path.apply(scene, frame % max(1, args.frames))
+        renderer.render(scene)
+    glFinish()
+    profiler.reset()
+
+    frames = []
+    for frame in range(args.frames):
+        path.apply(scene, frame)
+        start = time.perf_counter()
+        renderer.render(scene)
+        cpu = time.perf_counter() - start
+        glFinish()
+        total = time.perf_counter() - start
+        frames.append({"frame": frame, "cpu": cpu * 1000, "frame_time": total * 1000})
+    profiler.flush()
+
+    for result in profiler.results:
+        passes = FrameProfiler.scopeTimes(result)
+        frame = frames[result["frame"]]
+        frame["cpu_passes"] = {name: cpu for name, (cpu, _) in passes.items()}
+        frame["gpu"] = {name: gpu for name, (_, gpu) in passes.items()}
+        frame["gpu_total"] = FrameProfiler.scopeTimes(result, depth=0)["frame"][1]
+        frame["counters"] = result["counters"]
+    if args.trace:
+        profiler.exportTrace(args.trace)
+
+    meta = {
+        "frames": args.frames,
+        "warmup": args.warmup,
+        "size": [width, height],
+        "scale": args.scale,
+        "depth_prepass": args.depth_prepass,
+        "path": args.path or "orbit",
+        "platform": args.platform,
+        "gl_renderer": glGetString(GL_RENDERER).decode(),
+        "gl_version": glGetString(GL_VERSION).decode(),
+        "python": platform.python_version(),
+    }
+
+    profiler.destroy()
+    target.destroy()
+    renderer.quit()
+    destroy_headless_context(args.platform, handles)
+    return meta, frames
+
+def build_summary(frames):
+    summary = {
+        "cpu": summarize([frame["cpu"] for frame in frames]),
+        "frame_time": summarize([frame["frame_time"] for frame in frames]),
+        "gpu_total": summarize([frame.get("gpu_total", 0) for frame in frames]),
+    }
+    #проход, пропущенный в кадре (например карта теней из кэша), считается за 0
+    for key, prefix in (("cpu_passes", "cpu"), ("gpu", "gpu")):
+        passes = sorted({name for frame in frames for name in frame.get(key, {})})
+        for name in passes:
+            summary[f"{prefix}.{name}"] = summarize([frame.get(key, {}).get(name, 0) for frame in frames])
+    return summary
+
+def print_summary(summary):
+    print(f"{'metric':<16} " + " ".join(f"{name:>9}" for name in ("p50", "p95", "p99", "mean", "max")))
+    for metric, values in summary.items():
+        print(f"{metric:<16} " + " ".join(f"{values[name]:>9.2f}" for name in ("p50", "p95", "p99", "mean", "max")))
+
+#сравнение с прошлым прогоном: рост p95 больше чем на threshold процентов - регрессия;
+#метрики с базовым p95 меньше minMs только печатаются
+def compare(summary, baseline, threshold, minMs=MIN_COMPARE_MS):
+    regressions = []
+    print(f"\n{'metric':<16} {'base p95':>9} {'p95':>9} {'change':>8}")
+    for metric, values in summary.items():
+        if metric not in baseline:
+            continue
+        before = baseline[metric]["p95"]
+        after = values["p95"]
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        if before < minMs:
+            flag = "  (below floor)"
+        else:
+            flag = "  REGRESSION" if change > threshold else ""
+        print(f"{metric:<16} {before:>9.2f} {after:>9.2f} {change:>+7.1f}%{flag}")
+        if flag == "  REGRESSION":
+            regressions.append(metric)
+    return regressions
+
+#воспроизводимый замер времени кадра без окна: фиксированный путь камеры и число кадров,
+#результаты - JSON для сравнения между сборками
+def main():
+    parser = argparse.ArgumentParser(description="Headless frame-time benchmark over a scripted camera path.")
+    parser.add_argument("--frames", type=int, default=300, help="number of measured frames")
+    parser.add_argument("--warmup", type=int, default=30, help="frames rendered before measuring")
+    parser.add_argument("--size", type=parse_size, default=None, help="render size WxH (default: window framebuffer size)")
+    parser.add_argument("--path", default=None, help="camera path JSON, e.g. recorded with main.py --record (default: orbit)")
+    parser.add_argument("--platform", choices=("egl", "osmesa"), default="egl", help="headless OpenGL platform")
+    parser.add_argument("--scale", type=float, default=1.0, help="internal render scale, upscaled to the frame size")
+    parser.add_argument("--no-depth-prepass", dest="depth_prepass", action="store_false", help="shade without a depth pre-pass")
+    parser.add_argument("--output", default=None, help="write results JSON here")
+    parser.add_argument("--trace", default=None, help="write a Chrome trace JSON of the measured frames here")
+    parser.add_argument("--compare", default=None, help="baseline results JSON to compare p95 against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed p95 growth in percent")
+    parser.add_argument("--min-ms", type=float, default=MIN_COMPARE_MS, help="skip metrics whose baseline p95 is below this (ms)")
+    args = parser.parse_args()
+
+    select_platform(args.platform)
+    meta, frames = run(args)
+    summary = build_summary(frames)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"meta": meta, "summary": summary, "frames": frames}, file, indent=1)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)["summary"]
+        if compare(summary, baseline, args.threshold, args.min_ms):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
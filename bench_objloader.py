@@ -0,0 +1,95 @@
+import glob
+import sys
+import time
+
+import numpy as np
+
+from main import load_obj_mesh
+
+#старый построчный загрузчик obj - эталон для сравнения
+def legacy_load_mesh(filename):
+    v = []
+    vt = []
+    vn = []
+
+    vertices = []
+
+    with open(filename, 'r') as file:
+        line = file.readline()
+        while line:
+            words = line.split(" ")
+            if words[0] == "v":
+                v.append([float(words[1]), float(words[2]), float(words[3])])
+            elif words[0] == "vt":
+                vt.append([float(words[1]), float(words[2])])
+            elif words[0] == "vn":
+                vn.append([float(words[1]), float(words[2]), float(words[3])])
+            elif words[0] == "f":
+                legacy_read_face_data(words, v, vt, vn, vertices)
+            line = file.readline()
+
+    return np.array(vertices, dtype=np.float32)
+
+def legacy_read_face_data(words, v, vt, vn, vertices):
+    triangleCount = len(words) - 3
+
+    for i in range(triangleCount):
+        tangent, bitangent = legacy_get_face_orientation(words, 1, 2 + i, 3 + i, v, vt)
+
+        legacy_make_corner(words[1], v, vt, vn, vertices, tangent, bitangent)
+        legacy_make_corner(words[2 + i], v, vt, vn, vertices, tangent, bitangent)
+        legacy_make_corner(words[3 + i], v, vt, vn, vertices, tangent, bitangent)
+
+def legacy_get_face_orientation(words, a, b, c, v, vt):
+    v_vt_vn = words[a].split("/")
+    pos1 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
+    uv1 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
+
+    v_vt_vn = words[b].split("/")
+    pos2 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
+    uv2 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
+
+    v_vt_vn = words[c].split("/")
+    pos3 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
+    uv3 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
+
+    dPos1 = pos2 - pos1
+    dPos2 = pos3 - pos1
+    dUV1 = uv2 - uv1
+    dUV2 = uv3 - uv1
+    k = (dUV1[0] * dUV2[1] - dUV2[0] * dUV1[1])
+
+    den = 1 / k
+    tangent = [den * (dUV2[1] * dPos1[i] - dUV1[1] * dPos2[i]) for i in range(3)]
+    bitangent = [den * (-dUV2[0] * dPos1[i] + dUV1[0] * dPos2[i]) for i in range(3)]
+
+    return (tangent, bitangent)
+
+def legacy_make_corner(corner_description, v, vt, vn, vertices, tangent, bitangent):
+    v_vt_vn = corner_description.split("/")
+    if (v_vt_vn[0] != '\n'):
+        vertices.extend(v[int(v_vt_vn[0]) - 1])
+        vertices.extend(vt[int(v_vt_vn[1]) - 1])
+        vertices.extend(vn[int(v_vt_vn[2]) - 1])
+        vertices.extend(tangent)
+        vertices.extend(bitangent)
+
+#лучшее время из нескольких запусков
+def best_time(loader, filename, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = loader(filename)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main(filenames, repeats=5):
+    print(f"{'model':<40} {'legacy ms':>10} {'numpy ms':>10} {'speedup':>8}  identical")
+    for filename in filenames:
+        old_time, old = best_time(legacy_load_mesh, filename, repeats)
+        new_time, new = best_time(load_obj_mesh, filename, repeats)
+        identical = old.shape == new.shape and np.array_equal(old, new, equal_nan=True)
+        print(f"{filename:<40} {old_time * 1000:>10.2f} {new_time * 1000:>10.2f} {old_time / new_time:>7.1f}x  {identical}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or sorted(glob.glob("models/*.obj")))
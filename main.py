@@ -1,14 +1,92 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import glfw
 import glfw.GLFW as GLFWC
 from OpenGL.GL import *
 import numpy as np
 from OpenGL.GL.shaders import compileProgram, compileShader
+from OpenGL.raw.GL.VERSION.GL_3_2 import glGetInteger64v as raw_glGetInteger64v
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as raw_glGetQueryObjectui64v
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT, GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
 import pyrr 
 from PIL import Image
 
 SCREEN_WIDTH = 1640
 SCREEN_HEIGHT = 880
 
+#кэш готовых вершинных буферов obj моделей
+MESH_CACHE_DIR = "cache/meshes"
+MESH_CACHE_VERSION = 3
+MESH_CACHE_KEYS = ("version", "size", "mtime", "hash", "vertex_count", "index_count")
+
+#лимит видеопамяти под текстуры материалов в байтах, None - без ограничения
+TEXTURE_BUDGET = None
+
+#вся статическая геометрия в общих буферах и отрисовка через glMultiDrawElementsIndirect
+#(нужен OpenGL 4.3, иначе - отдельный вызов на меш)
+MULTI_DRAW_INDIRECT = True
+
+#предварительный проход глубины: сначала только глубина (объекты от ближних к дальним), затем
+#освещение с GL_EQUAL - тяжёлый фрагментный шейдер выполняется один раз на пиксель.
+#Отладка перерисовки (--overdraw): каждый закрашенный фрагмент добавляет OVERDRAW_STEP к яркости
+DEPTH_PREPASS = True
+OVERDRAW_STEP = 1 / 8
+
+#проекция камеры
+CAMERA_FOVY = 45
+CAMERA_NEAR = 0.1
+CAMERA_FAR = 1000
+
+#скорость камеры (единиц в секунду) и поворот на пиксель сдвига мыши (градусы)
+CAMERA_SPEED = 30
+MOUSE_SENSITIVITY = 1.0
+
+#цикл приложения: шаг симуляции (с), ограничение частоты кадров (None - без ограничения),
+#предел времени кадра, учитываемого симуляцией (после долгих пауз), и остаток ожидания кадра, который
+#не спит, а крутится в цикле (sleep просыпается с запаздыванием)
+SIMULATION_STEP = 1 / 60
+FRAME_CAP = 120
+MAX_FRAME_DELTA = 0.25
+PACING_SPIN = 0.0005
+
+#вывод кадров: двойная буферизация окна и интервал смены буферов (1 - по вертикальной синхронизации, 0 - сразу),
+#число кадров, которые cpu может подготовить вперёд gpu (сегменты кольцевых буферов данных кадра),
+#и шаг ожидания забора кадра (нс)
+DOUBLE_BUFFER = True
+SWAP_INTERVAL = 1
+FRAMES_IN_FLIGHT = 2
+FENCE_TIMEOUT = 1_000_000
+
+#внутреннее разрешение - доля размера окна в пикселях (1 - без масштабирования); динамическое разрешение
+#(--dynamic-resolution) держит масштаб в пределах RENDER_SCALE_RANGE и меняет его ступенями
+#RENDER_SCALE_STEP не чаще раза в RESOLUTION_INTERVAL кадров
+RENDER_SCALE = 1.0
+RENDER_SCALE_RANGE = (0.5, 2.0)
+RENDER_SCALE_STEP = 0.05
+RESOLUTION_INTERVAL = 30
+
+#начальный размер сегмента кольцевых буферов кластеров освещения (байт); растёт по необходимости
+LIGHT_RING_SEGMENT = 64 * 1024
+#то же для матриц экземпляров и команд пакетов multi-draw indirect
+BATCH_RING_SEGMENT = 64 * 1024
+
+#профилировщик (--profile): сколько последних кадров хранится для трассировки
+PROFILER_TRACE_FRAMES = 600
+
+#каскадные карты теней: разрешение слоя, число каскадов (не больше MAX_CASCADES в fragment.txt),
+#дальность теней от камеры, доля логарифмического разбиения и запас глубины за каскадом для отбрасывающих тень
+SHADOW_MAP_RES = 1024
+SHADOW_CASCADES = 3
+SHADOW_DISTANCE = 40
+SHADOW_SPLIT_LAMBDA = 0.75
+SHADOW_CASTER_MARGIN = 50
+
 ENTITY_TYPE = {
     "CARPET": 0,
     "POINTLIGHT": 1,
@@ -24,40 +102,86 @@ ENTITY_TYPE = {
     "CHAIRS1": 11,
 }
 
+#отдельные юниформы - только то, что меняется между вызовами отрисовки;
+#данные кадра и источники света идут через блоки юниформ (см. UniformBlocks)
 UNIFORM_TYPE = {
     "AMBIENT": 0,
-    "VIEW": 1,
-    "PROJECTION": 2,
-    "CAMERA_POS": 3,
-    "LIGHT_COLOR": 4,
-    "LIGHT_POS": 5,
-    "LIGHT_STRENGTH": 6,
-    "TINT": 7,
-    "MODEL": 8,
-    "LIGHT_SPTRANS": 9,
+    "TINT": 1,
+    "LIGHT_SPTRANS": 2,
+    "MATERIAL_PACKED": 3,
+}
+
+#блок юниформ std140: раскладка совпадает с FrameData в шейдерах
+MAX_CASCADES = 4
+
+FRAME_DATA = np.dtype({
+    "names": [
+        "view", "projection", "cameraPos", "cascadeCount", "cascadeSplits", "lightSpaceTransforms",
+        "clusterGrid", "lightCount", "clusterParams"
+    ],
+    "formats": [
+        ("<f4", (4, 4)), ("<f4", (4, 4)), ("<f4", 3), "<i4", ("<f4", MAX_CASCADES), ("<f4", (MAX_CASCADES, 4, 4)),
+        ("<i4", 3), "<i4", ("<f4", 4)
+    ],
+    "offsets": [0, 64, 128, 140, 144, 160, 160 + MAX_CASCADES * 64, 172 + MAX_CASCADES * 64, 176 + MAX_CASCADES * 64],
+    "itemsize": 192 + MAX_CASCADES * 64,
+})
+
+UNIFORM_BLOCK_BINDING = {
+    "FrameData": 0,
 }
 
-def initialize_glfw():
+#кластеры освещения: плитки экрана по x и y и слои глубины (логарифмические, от CAMERA_NEAR до CAMERA_FAR)
+LIGHT_CLUSTER_GRID = (16, 9, 24)
+
+#вклад источника на границе его радиуса действия (сила ослабевает как 1 / расстояние)
+LIGHT_CUTOFF = 0.005
+
+#источник в буфере света - два текселя RGBA32F: позиция и радиус, цвет и сила
+LIGHT_DATA = np.dtype([("position", "<f4", 3), ("radius", "<f4"), ("color", "<f4", 3), ("strength", "<f4")])
+
+def initialize_glfw(doubleBuffer=DOUBLE_BUFFER, swapInterval=SWAP_INTERVAL):
     glfw.init()
     glfw.window_hint(GLFWC.GLFW_CONTEXT_VERSION_MAJOR, 4)
     glfw.window_hint(GLFWC.GLFW_CONTEXT_VERSION_MINOR, 1)
     glfw.window_hint(GLFWC.GLFW_OPENGL_PROFILE, GLFWC.GLFW_OPENGL_CORE_PROFILE)
     glfw.window_hint(GLFWC.GLFW_OPENGL_FORWARD_COMPAT, GLFWC.GLFW_TRUE)
-    glfw.window_hint(GLFWC.GLFW_DOUBLEBUFFER, GL_FALSE)
+    glfw.window_hint(GLFWC.GLFW_DOUBLEBUFFER, GL_TRUE if doubleBuffer else GL_FALSE)
 
     window = glfw.create_window(SCREEN_WIDTH, SCREEN_HEIGHT, "Lab4 Shevchenko", None, None)
     glfw.make_context_current(window)
     glfw.set_input_mode(window, GLFWC.GLFW_CURSOR, GLFWC.GLFW_CURSOR_HIDDEN)
+    if doubleBuffer:
+        glfw.swap_interval(swapInterval)
 
     return window
 
 
 class App:
 
-    def __init__(self, window):
+    #recordPath - файл, куда при выходе сохраняется пройденный путь камеры (CameraPath),
+    #profilePath - файл трассировки профилировщика (без него профилировщик выключен),
+    #targetFrameMs - цель динамического разрешения (None - масштаб renderScale не меняется),
+    #overdraw - вместо освещения показать перерисовку
+    def __init__(self, window, recordPath=None, frameCap=FRAME_CAP, doubleBuffer=DOUBLE_BUFFER, framesInFlight=FRAMES_IN_FLIGHT,
+                 profilePath=None, renderScale=RENDER_SCALE, targetFrameMs=None, depthPrepass=DEPTH_PREPASS, overdraw=False):
+        self.startTime = time.perf_counter()
         self.window = window
-        self.renderer = GraphicsEngine()
+        self.doubleBuffer = doubleBuffer
+        self.renderer = GraphicsEngine(framesInFlight=framesInFlight, renderScale=renderScale, depthPrepass=depthPrepass)
+        self.renderer.setDebugOverdraw(overdraw)
+        self.renderer.setRenderTarget(0, *glfw.get_framebuffer_size(window))
+        self.windowCenter = [size / 2 for size in glfw.get_window_size(window)]
+        glfw.set_framebuffer_size_callback(window, self.onFramebufferResize)
+        glfw.set_window_size_callback(window, self.onWindowResize)
+        self.resolution = None if targetFrameMs is None else ResolutionController(targetFrameMs, renderScale)
+        self.profilePath = profilePath
+        if profilePath is not None:
+            self.renderer.profiler = FrameProfiler()
         self.scene = Scene()
+        self.recordPath = recordPath
+        self.recordedFrames = []
+        self.clock = FrameClock(SIMULATION_STEP, frameCap)
 
         self.lastTime = glfw.get_time()
         self.currentTime = 0
@@ -89,14 +213,64 @@ class App:
             if glfw.window_should_close(self.window) or glfw.get_key(self.window, GLFWC.GLFW_KEY_ESCAPE) == GLFWC.GLFW_PRESS:
                 running = False
             
+            glfw.poll_events()
+            self.frameTime = self.clock.tick() * 1000
             self.handleKeys()
             self.handleMouse()
-            glfw.poll_events()
-            #self.scene.update(self.frameTime / 16.7)
-            self.renderer.render(self.scene)
+
+            #симуляция - шагами фиксированной длины, кадр - между двумя последними шагами
+            for _ in range(self.clock.steps()):
+                self.scene.update(self.clock.step)
+            self.renderInterpolated(self.clock.alpha)
+            self.present()
+
+            if self.recordPath is not None:
+                self.recordFrame()
+            if self.numFrames == 0 and self.startTime is not None:
+                self.reportFirstFrame()
             self.calculateFramerate()
+            self.clock.pace()
         self.quit() #выход из приложения
 
+    #с двойной буферизацией кадр показывает смена буферов (с интервалом swap interval),
+    #без неё - glFlush в единственный буфер
+    def present(self):
+        if self.doubleBuffer:
+            glfw.swap_buffers(self.window)
+        else:
+            glFlush()
+
+    #позиция камеры на кадре - между предыдущим и текущим шагом симуляции
+    def renderInterpolated(self, alpha):
+        camera = self.scene.camera
+        position = camera.position
+        camera.position = camera.interpolatedPosition(alpha)
+        if self.resolution is None:
+            self.renderer.render(self.scene)
+        else:
+            self.resolution.begin()
+            self.renderer.render(self.scene)
+            self.resolution.end()
+            scale = self.resolution.update()
+            if scale is not None:
+                self.renderer.setRenderScale(scale)
+        camera.position = position
+
+    #размер framebuffer окна в пикселях; свёрнутое окно (0x0) рисует в прежний размер
+    def onFramebufferResize(self, window, width, height):
+        if width > 0 and height > 0:
+            self.renderer.setRenderTarget(0, width, height)
+
+    def onWindowResize(self, window, width, height):
+        self.windowCenter = [width / 2, height / 2]
+
+    #время до первого кадра - от создания приложения до готового изображения
+    def reportFirstFrame(self):
+        glFinish()
+        elapsed = time.perf_counter() - self.startTime
+        print(f"time to first frame: {elapsed * 1000:.0f} ms (assets {self.renderer.loadTime * 1000:.0f} ms)")
+        self.startTime = None
+
     def handleKeys(self):
         combo_move = 0
         directionModifier = 0
@@ -110,45 +284,197 @@ class App:
         if glfw.get_key(self.window, GLFWC.GLFW_KEY_D) == GLFWC.GLFW_PRESS:
             combo_move += 8
             
+        #клавиши задают скорость камеры, сдвигает её Scene.update
+        velocity = np.zeros(3, dtype=np.float32)
         if combo_move in self.walk_offset_lookup:
             directionModifier = self.walk_offset_lookup[combo_move]
-            dPos = [
-                0.5 * self.frameTime / 16.7 * np.cos(np.deg2rad(-self.scene.camera.phi + directionModifier)),
+            velocity[:] = [
+                CAMERA_SPEED * np.cos(np.deg2rad(-self.scene.camera.phi + directionModifier)),
                 0,
-                -0.5 * self.frameTime / 16.7 * np.sin(np.deg2rad(-self.scene.camera.phi + directionModifier)),
+                -CAMERA_SPEED * np.sin(np.deg2rad(-self.scene.camera.phi + directionModifier)),
             ]
-            self.scene.move_camera(dPos)
-            
+        self.scene.camera.velocity = velocity
+
+    #поворот - сразу, в каждом кадре: сдвиг мыши в пикселях от частоты кадров не зависит
     def handleMouse(self):
         (x, y) = glfw.get_cursor_pos(self.window)
-        rate = self.frameTime / 16.7
-        phi_increment = rate * ((SCREEN_WIDTH / 2) - x)
-        theta_increment = rate * ((SCREEN_HEIGHT / 2) - y)
+        centerX, centerY = self.windowCenter
+        phi_increment = MOUSE_SENSITIVITY * (centerX - x)
+        theta_increment = MOUSE_SENSITIVITY * (centerY - y)
         self.scene.spin_camera(phi_increment, theta_increment)
-        glfw.set_cursor_pos(self.window, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)
+        glfw.set_cursor_pos(self.window, centerX, centerY)
 
     def calculateFramerate(self):
         self.currentTime = glfw.get_time()
         delta = self.currentTime - self.lastTime
         if (delta >= 1):
             framerate = max(1, int(self.numFrames / delta))
-            glfw.set_window_title(self.window, f"{framerate} fps.")
+            cullStats = self.renderer.cullStats
+            glStats = GL_STATE.frameStats
+            width, height = self.renderer.viewportSize
+            glfw.set_window_title(
+                self.window,
+                f"{framerate} fps, {width}x{height} (x{self.renderer.renderScale:g}). drawn {cullStats['drawn']}, culled {cullStats['culled']}, "
+                f"gl binds {glStats['issued']} (elided {glStats['elided']}), draw calls {glStats['draws']}"
+                + self.overdrawOverlay() + self.profileOverlay())
             self.lastTime = self.currentTime
             self.numFrames = -1
-            self.frameTime = float(1000.0/max(1, framerate))
         self.numFrames += 1
 
+    def overdrawOverlay(self):
+        overdraw = self.renderer.overdraw
+        return "" if overdraw is None else f", overdraw {overdraw:.2f}"
+
+    #время проходов последнего прочитанного кадра, cpu/gpu в мс, и счётчики кадра
+    def profileOverlay(self):
+        profiler = self.renderer.profiler
+        if profiler is None or not profiler.results:
+            return ""
+        result = profiler.results[-1]
+        passes = ", ".join(f"{name} {cpu:.1f}/{gpu:.1f}" for name, (cpu, gpu) in FrameProfiler.scopeTimes(result).items())
+        counters = result["counters"]
+        return (f". cpu/gpu ms: {passes}; tris {counters['triangles']}, "
+                f"tex binds {counters['textureBinds']}, uniform uploads {counters['uniformUploads']}")
+
+    def recordFrame(self):
+        camera = self.scene.camera
+        self.recordedFrames.append({
+            "frame": len(self.recordedFrames),
+            "position": camera.position.tolist(),
+            "theta": float(camera.theta),
+            "phi": float(camera.phi),
+        })
+
     def quit(self):
+        if self.recordPath is not None and self.recordedFrames:
+            CameraPath(self.recordedFrames).save(self.recordPath)
+        profiler = self.renderer.profiler
+        if profiler is not None:
+            profiler.flush()
+            profiler.exportTrace(self.profilePath)
+            profiler.destroy()
+        if self.resolution is not None:
+            self.resolution.destroy()
+        shadowStats = self.renderer.shadowStats
+        print(f"shadow map: rendered {shadowStats['rendered']} frames, reused in {shadowStats['reused']}")
         self.renderer.quit()
 
+#часы цикла приложения: время кадра по монотонным часам, накопитель для шагов симуляции
+#фиксированной длины и ожидание до следующего кадра при ограничении частоты
+class FrameClock:
+    def __init__(self, step=SIMULATION_STEP, frameCap=FRAME_CAP, maxDelta=MAX_FRAME_DELTA):
+        self.step = step
+        self.frameInterval = 1 / frameCap if frameCap else 0
+        self.maxDelta = maxDelta
+        self.last = time.perf_counter()
+        self.nextFrame = self.last
+        self.accumulator = 0.0
+        self.delta = 0.0
+
+    #время с прошлого кадра (с); слишком долгий кадр урезается, чтобы симуляция не догоняла его десятками шагов
+    def tick(self):
+        now = time.perf_counter()
+        self.delta = min(now - self.last, self.maxDelta)
+        self.last = now
+        self.accumulator += self.delta
+        return self.delta
+
+    #число шагов симуляции, накопившихся к этому кадру
+    def steps(self):
+        count = int(self.accumulator // self.step)
+        self.accumulator -= count * self.step
+        return count
+
+    #доля шага, прошедшая после последнего шага симуляции - для интерполяции
+    @property
+    def alpha(self):
+        return self.accumulator / self.step
+
+    #ожидание начала следующего кадра: сон, затем короткий цикл до точного момента;
+    #отставший кадр не наверстывается
+    def pace(self):
+        if not self.frameInterval:
+            return
+        now = time.perf_counter()
+        self.nextFrame = max(self.nextFrame + self.frameInterval, now)
+        remaining = self.nextFrame - now
+        if remaining > PACING_SPIN:
+            time.sleep(remaining - PACING_SPIN)
+        while time.perf_counter() < self.nextFrame:
+            pass
+
+#динамическое разрешение: время кадра на gpu (GL_TIMESTAMP до и после render, читается без ожидания)
+#сглаживается, и масштаб подбирается так, чтобы оно было около targetMs; время на пиксели ~ масштаб^2
+class ResolutionController:
+    def __init__(self, targetMs, scale=RENDER_SCALE, scaleRange=RENDER_SCALE_RANGE, step=RENDER_SCALE_STEP, interval=RESOLUTION_INTERVAL):
+        self.targetMs = targetMs
+        self.scale = scale
+        self.minScale, self.maxScale = scaleRange
+        self.step = step
+        self.interval = interval
+        self.frames = 0
+        self.gpuMs = None
+        self.free = []
+        self.start = None
+        self.pending = deque()
+
+    def timestamp(self):
+        query = self.free.pop() if self.free else int(glGenQueries(1)[0])
+        glQueryCounter(query, GL_TIMESTAMP)
+        return query
+
+    def begin(self):
+        self.start = self.timestamp()
+
+    #пара запросов помечается масштабом, с которым нарисован кадр
+    def end(self):
+        self.pending.append((self.start, self.timestamp(), self.scale))
+
+    #новый масштаб или None, если менять не нужно
+    def update(self):
+        while self.pending and glGetQueryObjectiv(self.pending[0][1], GL_QUERY_RESULT_AVAILABLE):
+            start, end, scale = self.pending.popleft()
+            #кадры, нарисованные до смены масштаба, в оценку не идут - запросы только возвращаются в free
+            if scale == self.scale:
+                ms = (query_result(end) - query_result(start)) / 1e6
+                self.gpuMs = ms if self.gpuMs is None else 0.9 * self.gpuMs + 0.1 * ms
+            self.free += (start, end)
+
+        self.frames += 1
+        if self.gpuMs is None or self.frames < self.interval:
+            return None
+        self.frames = 0
+
+        #отклонение в пределах 10% не исправляется - иначе масштаб колеблется
+        ratio = self.targetMs / self.gpuMs
+        if 0.9 < ratio < 1.1:
+            return None
+        scale = round(round(self.scale * np.sqrt(ratio) / self.step) * self.step, 2)
+        scale = min(max(scale, self.minScale), self.maxScale)
+        if scale == self.scale:
+            return None
+        self.scale = scale
+        self.gpuMs = None
+        return scale
+
+    def destroy(self):
+        queries = self.free + [query for start, end, _ in self.pending for query in (start, end)]
+        if queries:
+            glDeleteQueries(len(queries), queries)
+
 #камера
 class Camera:
     def __init__(self, position):
         self.position = np.array(position, dtype=np.float32)
+        self.previousPosition = self.position.copy()
+        self.velocity = np.zeros(3, dtype=np.float32)
         self.theta = 0
         self.phi = 0
         self.update()
 
+    def interpolatedPosition(self, alpha):
+        return self.previousPosition + (self.position - self.previousPosition) * np.float32(alpha)
+
     def update(self):
         self.forwards = np.array(
             [
@@ -164,6 +490,50 @@ class Camera:
 
         self.up = np.cross(self.right, self.forwards)
 
+#сценарий движения камеры: ключевые кадры {"frame", "position", "theta", "phi"},
+#между ними - линейная интерполяция (phi не сворачивается, обход по кругу - возрастающими углами)
+class CameraPath:
+    def __init__(self, keyframes):
+        self.keyframes = sorted(keyframes, key=lambda keyframe: keyframe["frame"])
+        self.frames = np.array([keyframe["frame"] for keyframe in self.keyframes], dtype=np.float64)
+        self.poses = np.array(
+            [list(keyframe["position"]) + [keyframe["theta"], keyframe["phi"]] for keyframe in self.keyframes],
+            dtype=np.float64)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as file:
+            return cls(json.load(file)["keyframes"])
+
+    def save(self, filename):
+        with open(filename, 'w') as file:
+            json.dump({"keyframes": self.keyframes}, file, indent=1)
+
+    #облёт сцены по кругу с камерой, смотрящей в центр
+    @classmethod
+    def orbit(cls, frames, radius=12, height=3, center=(0, 0, 0), steps=16):
+        keyframes = []
+        for i in range(steps + 1):
+            angle = 2 * np.pi * i / steps
+            position = np.array(center, dtype=np.float64) + (radius * np.cos(angle), height, radius * np.sin(angle))
+            keyframes.append({
+                "frame": frames * i / steps,
+                "position": position.tolist(),
+                "theta": float(-np.rad2deg(np.arctan2(height, radius))),
+                "phi": float(np.rad2deg(angle) + 180),
+            })
+        return cls(keyframes)
+
+    def pose(self, frame):
+        pose = [np.interp(frame, self.frames, self.poses[:, i]) for i in range(5)]
+        return (np.array(pose[:3], dtype=np.float32), pose[3], pose[4])
+
+    #камера сцены ставится в позу кадра через те же move_camera/spin_camera, что и управление
+    def apply(self, scene, frame):
+        position, theta, phi = self.pose(frame)
+        scene.move_camera(position - scene.camera.position)
+        scene.spin_camera(scene.camera.phi - phi, theta - scene.camera.theta)
+
 #сцена
 class Scene:
     def __init__(self):
@@ -313,12 +683,97 @@ class Scene:
             ],
 
             ENTITY_TYPE["POINTLIGHT"]: [
-                LightObj(self.lights[i], eulers=[0, 0, 0]) for i in range(8)
+                LightObj(light, eulers=[0, 0, 0]) for light in self.lights
             ]
         }
 
         self.camera = Camera(position=[0, 3, 12])
 
+        self.buildTransforms()
+
+        #активные источники (с ненулевым радиусом действия) - подряд в начале lightData,
+        #при изменении источника обновляется только его строка
+        self.lightData = np.zeros(len(self.lights), dtype=LIGHT_DATA)
+        self.lightCount = 0
+        self.lightSlots: dict[Light, int] = {}
+        self.slotLights: list[Light] = []
+        for light in self.lights:
+            self.watchLight(light)
+
+    #матрицы моделей всех объектов сцены одним массивом (N, 4, 4),
+    #объекты одного типа лежат подряд - срез transformRanges[entityType]
+    def buildTransforms(self):
+        self.transformRanges: dict[int, tuple[int, int]] = {}
+        start = 0
+        for entityType, entities in self.entities.items():
+            self.transformRanges[entityType] = (start, start + len(entities))
+            start += len(entities)
+
+        self.transforms = np.zeros((start, 4, 4), dtype=np.float32)
+        self.transformVersions = [-1] * start
+        self.transformLayout = self.entityLayout()
+
+    #состав сцены: при добавлении/удалении объектов массив строится заново
+    def entityLayout(self):
+        return [(entityType, len(entities)) for entityType, entities in self.entities.items()]
+
+    #пересчёт изменившихся матриц; возвращает типы объектов, чьи срезы обновились
+    def updateTransforms(self):
+        if self.transformLayout != self.entityLayout():
+            self.buildTransforms()
+
+        changed = set()
+        for entityType, (start, end) in self.transformRanges.items():
+            for i, entity in enumerate(self.entities[entityType], start):
+                if self.transformVersions[i] != entity.version:
+                    self.transforms[i] = entity.getModelTransform()
+                    self.transformVersions[i] = entity.version
+                    changed.add(entityType)
+        return changed
+
+    def entityTransforms(self, entityType):
+        start, end = self.transformRanges[entityType]
+        return self.transforms[start:end]
+
+    def addLight(self, light):
+        self.lights.append(light)
+        self.watchLight(light)
+
+    def watchLight(self, light):
+        light.onChange = self.updateLight
+        self.updateLight(light)
+
+    #включившийся источник занимает слот после последнего активного, погасший - замещается последним
+    def updateLight(self, light):
+        slot = self.lightSlots.get(light)
+        if light.radius > 0:
+            if slot is None:
+                if self.lightCount == len(self.lightData):
+                    self.lightData = np.concatenate((self.lightData, np.zeros(max(1, len(self.lightData)), dtype=LIGHT_DATA)))
+                slot = self.lightCount
+                self.lightCount += 1
+                self.lightSlots[light] = slot
+                self.slotLights.append(light)
+            self.lightData[slot] = (light.position, light.radius, light.color, light.strength)
+
+        elif slot is not None:
+            self.lightCount -= 1
+            last = self.slotLights.pop()
+            del self.lightSlots[light]
+            if last is not light:
+                self.lightData[slot] = self.lightData[self.lightCount]
+                self.slotLights[slot] = last
+                self.lightSlots[last] = slot
+
+    def activeLights(self):
+        return self.lightData[:self.lightCount]
+
+    #шаг симуляции длиной dt секунд; предыдущая позиция камеры остаётся для интерполяции кадра
+    def update(self, dt):
+        self.camera.previousPosition = self.camera.position.copy()
+        if self.camera.velocity.any():
+            self.move_camera(self.camera.velocity * dt)
+
     def move_camera(self, dPos):
         dPos = np.array(dPos, dtype = np.float32)
         self.camera.position += dPos
@@ -332,12 +787,44 @@ class Scene:
         self.camera.update()
 
 #объект сцены
+#матрица модели пересчитывается только после изменения position/eulers:
+#присваивание увеличивает version, при изменении массива на месте нужен touch()
 class Obj3D:
     def __init__(self, position, eulers):
-        self.position = np.array(position, dtype=np.float32)
-        self.eulers = np.array(eulers, dtype=np.float32)
+        self.version = 0
+        self.transformVersion = -1
+        self.modelTransform = None
+        self.position = position
+        self.eulers = eulers
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position = np.array(value, dtype=np.float32)
+        self.version += 1
+
+    @property
+    def eulers(self):
+        return self._eulers
+
+    @eulers.setter
+    def eulers(self, value):
+        self._eulers = np.array(value, dtype=np.float32)
+        self.version += 1
+
+    def touch(self):
+        self.version += 1
 
     def getModelTransform(self):
+        if self.transformVersion != self.version:
+            self.modelTransform = self.computeModelTransform()
+            self.transformVersion = self.version
+        return self.modelTransform
+
+    def computeModelTransform(self):
         model_transform = pyrr.matrix44.create_identity(dtype=np.float32)
         #вращение
         model_transform = pyrr.matrix44.multiply(
@@ -355,22 +842,175 @@ class Obj3D:
         )
 
 #свет
+#присваивание position/color/strength/radius сообщает об изменении (onChange - обновление строки
+#в массиве активных источников сцены), при изменении массива на месте нужен touch()
 class Light:
-    def __init__(self, position, color, strength):
-        self.position = np.array(position, dtype=np.float32)
-        self.color = np.array(color, dtype=np.float32)
+    def __init__(self, position, color, strength, radius=None):
+        self.onChange = None
+        self._radius = radius
+        self.position = position
+        self.color = color
         self.strength = strength
 
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position = np.array(value, dtype=np.float32)
+        self.touch()
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, value):
+        self._color = np.array(value, dtype=np.float32)
+        self.touch()
+
+    @property
+    def strength(self):
+        return self._strength
+
+    @strength.setter
+    def strength(self, value):
+        self._strength = value
+        self.touch()
+
+    #радиус действия: задан явно или расстояние, на котором вклад падает до LIGHT_CUTOFF
+    @property
+    def radius(self):
+        if self._radius is not None:
+            return self._radius
+        return self._strength * float(self._color.max()) / LIGHT_CUTOFF
+
+    @radius.setter
+    def radius(self, value):
+        self._radius = value
+        self.touch()
+
+    def touch(self):
+        if self.onChange is not None:
+            self.onChange(self)
+
 #источник света
 class LightObj(Obj3D):
     def __init__(self, light, eulers):
         self.light = Light(light.position, light.color, light.strength)
-        self.position = light.position
-        self.eulers = eulers
-
+        super().__init__(self.light.position, eulers)
+
+
+#границы каскадов - расстояния от камеры, смесь логарифмического и равномерного разбиения
+def cascade_splits(near, far, count, blend=SHADOW_SPLIT_LAMBDA):
+    i = np.arange(1, count + 1) / count
+    logarithmic = near * (far / near) ** i
+    uniform = near + (far - near) * i
+    return (blend * logarithmic + (1 - blend) * uniform).astype(np.float32)
+
+def perspective_projection(aspect):
+    return pyrr.matrix44.create_perspective_projection(
+        fovy = CAMERA_FOVY, aspect = aspect, near = CAMERA_NEAR, far = CAMERA_FAR, dtype=np.float32)
+
+#8 углов части пирамиды видимости камеры между расстояниями near и far
+def frustum_corners(camera, near, far, fovy=CAMERA_FOVY, aspect=SCREEN_WIDTH / SCREEN_HEIGHT):
+    forwards = camera.forwards / np.linalg.norm(camera.forwards)
+    right = camera.right / np.linalg.norm(camera.right)
+    up = camera.up / np.linalg.norm(camera.up)
+    tan = np.tan(np.radians(fovy) / 2)
+
+    corners = []
+    for distance in (near, far):
+        center = camera.position + forwards * distance
+        h = up * distance * tan
+        w = right * distance * tan * aspect
+        corners += [center - w - h, center + w - h, center + w + h, center - w + h]
+    return np.array(corners, dtype=np.float32)
+
+#матрицы пространства света для каждого каскада: ортопроекция по описанной сфере части пирамиды,
+#центр привязан к сетке текселей, чтобы тени не дрожали при движении камеры
+def cascade_transforms(camera, lightDirection, splits, resolution, near=CAMERA_NEAR, aspect=SCREEN_WIDTH / SCREEN_HEIGHT):
+    lightDirection = lightDirection / np.linalg.norm(lightDirection)
+    globalUp = np.array([0, 1, 0] if abs(lightDirection[1]) < 0.99 else [0, 0, 1], dtype=np.float32)
+    lightView = pyrr.matrix44.create_look_at(np.zeros(3), lightDirection, globalUp, dtype=np.float32)
+
+    transforms = np.empty((len(splits), 4, 4), dtype=np.float32)
+    start = near
+    for i, end in enumerate(splits):
+        corners = frustum_corners(camera, start, end, aspect=aspect)
+        center = corners.mean(axis=0)
+        radius = np.ceil(np.linalg.norm(corners - center, axis=1).max() * 16) / 16
+
+        x, y, z, _ = np.append(center, 1) @ lightView
+        texel = 2 * radius / resolution
+        x = np.floor(x / texel) * texel
+        y = np.floor(y / texel) * texel
+        #глубина привязана к шагу в четверть радиуса, диапазон расширен на шаг в сторону источника -
+        #сдвиг камеры вдоль света в пределах шага не меняет матрицу
+        depthStep = radius / 4
+        z = np.floor(z / depthStep) * depthStep
+
+        lightProjection = pyrr.matrix44.create_orthogonal_projection(
+            x - radius, x + radius, y - radius, y + radius,
+            -z - depthStep - radius - SHADOW_CASTER_MARGIN, -z + radius, dtype=np.float32)
+        transforms[i] = pyrr.matrix44.multiply(lightView, lightProjection)
+        start = end
+    return transforms
+
+#6 плоскостей отсечения (a, b, c, d) из матрицы вид-проекция, нормали смотрят внутрь
+#матрицы pyrr умножаются справа (clip = p @ matrix), поэтому плоскости берутся из столбцов
+def frustum_planes(matrix):
+    m = np.asarray(matrix, dtype=np.float32)
+    planes = np.array([
+        m[:, 3] + m[:, 0], m[:, 3] - m[:, 0],
+        m[:, 3] + m[:, 1], m[:, 3] - m[:, 1],
+        m[:, 3] + m[:, 2], m[:, 3] - m[:, 2],
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+#пакетная проверка сфер (N, 3), (N,) против пирамиды видимости - маска (N,) видимых
+def spheres_in_frustum(planes, centers, radii):
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    return (distances >= -radii[:, None]).all(axis=1)
+
+#AABB кластеров освещения в координатах камеры (камера смотрит вдоль -z); кластер (i, j, k) имеет
+#номер (k * grid[1] + j) * grid[0] + i. Границы по x зависят только от (k, i), по y - от (k, j),
+#по z - от k, поэтому mins и maxs - по массиву на ось формы (gz, 1, gx), (gz, gy, 1), (gz, 1, 1)
+def cluster_bounds(projection, grid, near=CAMERA_NEAR, far=CAMERA_FAR):
+    gx, gy, gz = grid
+    depth = near * (far / near) ** (np.arange(gz + 1) / gz)
+    near, far = depth[:-1, None, None], depth[1:, None, None]
+
+    mins = []
+    maxs = []
+    #x и y точки на глубине d - ndc * d / масштаб проекции по оси; крайние значения - на ближней или дальней грани слоя
+    for axis, count, shape in ((0, gx, (1, 1, -1)), (1, gy, (1, -1, 1))):
+        edges = np.linspace(-1, 1, count + 1) / projection[axis, axis]
+        low, high = edges[:-1].reshape(shape), edges[1:].reshape(shape)
+        mins.append(np.minimum(low * near, low * far).astype(np.float32))
+        maxs.append(np.maximum(high * near, high * far).astype(np.float32))
+    mins.append((-far).astype(np.float32))
+    maxs.append((-near).astype(np.float32))
+    return (mins, maxs)
+
+#пересечение сфер источников с AABB кластеров: маска (C, L)
+def spheres_in_clusters(mins, maxs, centers, radii):
+    distance = 0
+    for axis in range(3):
+        c = centers[:, axis]
+        outside = np.maximum(np.maximum(mins[axis][..., None] - c, c - maxs[axis][..., None]), 0)
+        distance = distance + outside * outside
+    mask = distance <= radii ** 2
+    return mask.reshape(int(np.prod(mask.shape[:-1])), len(centers))
 
 class GraphicsEngine:
-    def __init__(self):
+    def __init__(self, shadowMapRes=SHADOW_MAP_RES, shadowCascades=SHADOW_CASCADES, framesInFlight=FRAMES_IN_FLIGHT,
+                 renderScale=RENDER_SCALE, depthPrepass=DEPTH_PREPASS):
+        #матрицы каскадов лежат в блоке FrameData и массиве в шейдере фиксированного размера
+        if not 1 <= shadowCascades <= MAX_CASCADES:
+            raise ValueError(f"shadowCascades must be between 1 and {MAX_CASCADES}, got {shadowCascades}")
+
         #инициализация opengl
         glClearColor(0.1, 0.2, 0.2, 1)  #цвет фона/очистки
 
@@ -383,66 +1023,159 @@ class GraphicsEngine:
         #glCullFace(GL_BACK)
 
 
+        loadStart = time.perf_counter()
+
+        objFiles = {
+            ENTITY_TYPE["CARPET"]: "models/carpet.obj",
+            ENTITY_TYPE["POINTLIGHT"]: "models/cube.obj",
+            ENTITY_TYPE["FRUITBOWL"]: "models/fruitbowl.obj",
+            ENTITY_TYPE["FRUITPEARS"]: "models/fruitpears.obj",
+            ENTITY_TYPE["TABLE"]: "models/table.obj",
+            ENTITY_TYPE["TABLEFRAME"]: "models/tableframe.obj",
+            ENTITY_TYPE["TABLELEGS"]: "models/tablelegs.obj",
+            ENTITY_TYPE["CHAIRS"]: "models/chairs2.obj",
+            ENTITY_TYPE["CHAIRS1"]: "models/chairs4.obj",
+        }
+
+        materialFiles = {
+            "Carpet": ("jpg", "png"),
+            "TableFrame": ("jpg", "jpg"),
+            "Chairs": ("jpeg", "jpeg"),
+            "Wall": ("jpg", "jpg"),
+            "Floor": ("jpg", "jpg"),
+            "FruitBowl": ("jpg", "jpg"),
+            "FruitPears": ("jpg", "jpg"),
+            "Table": ("jpg", "jpg"),
+        }
+
+        #разбор obj и декодирование картинок - в пуле потоков,
+        #в этом потоке (с контекстом opengl) остаются только загрузки в буферы и текстуры
+        loader = AssetLoader()
+        for filename in objFiles.values():
+            loader.requestMesh(filename, indexed=True, optimizeCache=True)
+        for filename, (filetype, filetypeNRM) in materialFiles.items():
+            loader.requestMaterial(filename, filetype, filetypeNRM)
+
         self.meshes: dict[int, Mesh] = {
-            ENTITY_TYPE["CARPET"]: ObjMesh("models/carpet.obj"),
-            ENTITY_TYPE["POINTLIGHT"]: ObjMesh("models/cube.obj"),
             ENTITY_TYPE["FLOOR"]: PlaneMesh(24, 24, 3),
             ENTITY_TYPE["WALL1"]: PlaneMesh(24, 15, 0.5),
             ENTITY_TYPE["WALL2"]: PlaneMesh(24, 15, 1),
-            ENTITY_TYPE["FRUITBOWL"]: ObjMesh("models/fruitbowl.obj"),
-            ENTITY_TYPE["FRUITPEARS"]: ObjMesh("models/fruitpears.obj"),
-            ENTITY_TYPE["TABLE"]: ObjMesh("models/table.obj"),
-            ENTITY_TYPE["TABLEFRAME"]: ObjMesh("models/tableframe.obj"),
-            ENTITY_TYPE["TABLELEGS"]: ObjMesh("models/tablelegs.obj"),
-            ENTITY_TYPE["CHAIRS"]: ObjMesh("models/chairs2.obj"),
-            ENTITY_TYPE["CHAIRS1"]: ObjMesh("models/chairs4.obj"),
         }
+        for entityType, filename in objFiles.items():
+            self.meshes[entityType] = ObjMesh(filename, indexed=True, optimizeCache=True, loader=loader)
 
-        mt = Material3D("Carpet", "jpg", "png")
-        tl = Material3D("TableFrame", "jpg", "jpg")
-        ch = Material3D("Chairs", "jpeg", "jpeg")
-        wl = Material3D("Wall", "jpg", "jpg")
+        #материалы и текстуры общие для всех типов объектов, кэш считает ссылки
+        self.textureCache = TextureCache(TEXTURE_BUDGET)
+        self.materialCache = MaterialCache(self.textureCache)
 
+        def material(filename):
+            filetype, filetypeNRM = materialFiles[filename]
+            return self.materialCache.acquire(filename, filetype, filetypeNRM, loader)
+
+        #у POINTLIGHT материала нет - источники света рисуются без текстур
         self.materials: dict[int, Material] = {
-            ENTITY_TYPE["CARPET"]: mt,
-            ENTITY_TYPE["POINTLIGHT"]: mt,
-            ENTITY_TYPE["FLOOR"]: Material3D("Floor", "jpg", "jpg"),
-            ENTITY_TYPE["WALL1"]: wl,
-            ENTITY_TYPE["WALL2"]: wl,
-            ENTITY_TYPE["FRUITBOWL"]: Material3D("FruitBowl", "jpg", "jpg"),
-            ENTITY_TYPE["FRUITPEARS"]: Material3D("FruitPears", "jpg", "jpg"),
-            ENTITY_TYPE["TABLE"]: Material3D("Table", "jpg", "jpg"),
-            ENTITY_TYPE["TABLEFRAME"]: tl,
-            ENTITY_TYPE["TABLELEGS"]: tl,
-            ENTITY_TYPE["CHAIRS"]: ch,
-            ENTITY_TYPE["CHAIRS1"]: ch
+            ENTITY_TYPE["CARPET"]: material("Carpet"),
+            ENTITY_TYPE["FLOOR"]: material("Floor"),
+            ENTITY_TYPE["WALL1"]: material("Wall"),
+            ENTITY_TYPE["WALL2"]: material("Wall"),
+            ENTITY_TYPE["FRUITBOWL"]: material("FruitBowl"),
+            ENTITY_TYPE["FRUITPEARS"]: material("FruitPears"),
+            ENTITY_TYPE["TABLE"]: material("Table"),
+            ENTITY_TYPE["TABLEFRAME"]: material("TableFrame"),
+            ENTITY_TYPE["TABLELEGS"]: material("TableFrame"),
+            ENTITY_TYPE["CHAIRS"]: material("Chairs"),
+            ENTITY_TYPE["CHAIRS1"]: material("Chairs")
         }
+        loader.shutdown()
+
+        self.loadTime = time.perf_counter() - loadStart
 
         self.shaders: dict[int, Shader] = {
             0: Shader("vertex.txt", "fragment.txt"),
             1: Shader("vertex_light.txt", "fragment_light.txt"),
-            2: Shader("vertex_lightmap.txt", "fragment_lightmap.txt")
+            2: Shader("vertex_lightmap.txt", "fragment_lightmap.txt"),
+            3: Shader("vertex_light.txt", "fragment_depth.txt")
         }
 
+        self.shadowMapRes = shadowMapRes
+        self.shadowCascades = shadowCascades
+        self.cascadeSplits = cascade_splits(CAMERA_NEAR, SHADOW_DISTANCE, shadowCascades)
+
         self.setOnetimeUnifs()
         self.getUnifsLocs()
+        self.aspect = SCREEN_WIDTH / SCREEN_HEIGHT
+        self.projection = perspective_projection(self.aspect)
+        #данные кадра пишутся в сегмент слота кадра, слот освобождается забором
+        self.frameFences = FrameFences(framesInFlight)
+        self.uniformBlocks = UniformBlocks(framesInFlight)
+        self.lightClusters = LightClusters(self.projection, framesInFlight=framesInFlight)
+
+        #кадр рисуется в scaledTarget размером outputSize * renderScale и растягивается в targetFramebuffer;
+        #при масштабе 1 - сразу в targetFramebuffer. viewportSize - размер, в котором рисуется сцена
+        self.targetFramebuffer = 0
+        self.outputSize = (SCREEN_WIDTH * 2, SCREEN_HEIGHT * 2)
+        self.viewportSize = self.outputSize
+        self.renderScale = renderScale
+        self.scaledTarget = None
+        self.setRenderScale(renderScale)
+
+        #профилировщик проходов (FrameProfiler), None - без замеров
+        self.profiler = None
+
+        #отладка перерисовки: основной проход рисуется шейдером источника (shaders[1]) с аддитивным
+        #смешиванием, запрос GL_SAMPLES_PASSED даёт число закрашенных фрагментов; overdraw -
+        #среднее их число на пиксель (последний прочитанный кадр); прочитанные запросы переиспользуются
+        self.depthPrepass = depthPrepass
+        self.debugOverdraw = False
+        self.overdraw = None
+        self.overdrawQueries = deque()
+        self.overdrawFree = []
 
-        self.shadowMapRes = 1024
         self.makeShadowMap()
+
+        #кэш карты теней: направление источника, текущие матрицы каскадов и счётчики кадров (перерисована / взята готовой)
+        self.shadowLightPosition = np.array([-7, 3, 1], dtype=np.float32)
+        self.shadowLightTarget = np.array([0, 0, 0], dtype=np.float32)
+        self.cascadeTransforms = None
+        self.shadowDirty = True
+        self.shadowStats = {"rendered": 0, "reused": 0}
+
+        #отсечение по пирамиде видимости: счётчики объектов последнего кадра (основной проход)
+        #и последней перерисовки карты теней (по всем каскадам)
+        self.cullStats = {"drawn": 0, "culled": 0, "shadowDrawn": 0, "shadowCulled": 0}
+
+        self.shadowQueue = RenderQueue()
+        self.litQueue = RenderQueue()
+
+        #при поддержке multi-draw indirect вся геометрия лежит в общих буферах, и каждый проход
+        #рисуется своим пакетом команд: каскад тени или группа одного материала - один вызов
+        self.staticGeometry = None
+        if MULTI_DRAW_INDIRECT and multi_draw_indirect_supported():
+            self.staticGeometry = StaticGeometry(dict.fromkeys(self.meshes.values()))
+            self.shadowBatch = IndirectBatch(self.staticGeometry, framesInFlight)
+            self.litBatch = IndirectBatch(self.staticGeometry, framesInFlight)
+            self.depthBatch = IndirectBatch(self.staticGeometry, framesInFlight)
+
+        #имена типов объектов по мешам - для участков профилировщика
+        self.meshNames = {self.meshes[entityType]: name for name, entityType in ENTITY_TYPE.items() if entityType in self.meshes}
     
+    #массив карт глубины - по слою на каскад; сравнение с глубиной фрагмента делает
+    #сэмплер (sampler2DArrayShadow), линейная фильтрация даёт PCF 2x2 на каждую выборку
     def makeShadowMap(self):
         self.depthMapFBO = glGenFramebuffers(1)
         self.depthMap = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, self.depthMap)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT, self.shadowMapRes, self.shadowMapRes, 0, GL_DEPTH_COMPONENT, GL_FLOAT, None)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
-        glTexParameterfv(GL_TEXTURE_2D, GL_TEXTURE_BORDER_COLOR, np.array([1.0, 1.0, 1.0, 1.0], dtype=np.float32))
+        GL_STATE.bindTexture(GL_TEXTURE_2D_ARRAY, self.depthMap)
+        glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_DEPTH_COMPONENT, self.shadowMapRes, self.shadowMapRes, self.shadowCascades, 0, GL_DEPTH_COMPONENT, GL_FLOAT, None)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
+        glTexParameterfv(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_BORDER_COLOR, np.array([1.0, 1.0, 1.0, 1.0], dtype=np.float32))
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_COMPARE_MODE, GL_COMPARE_REF_TO_TEXTURE)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_COMPARE_FUNC, GL_LEQUAL)
 
         glBindFramebuffer(GL_FRAMEBUFFER, self.depthMapFBO)
-        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, self.depthMap, 0)
+        glFramebufferTextureLayer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, self.depthMap, 0, 0)
         glDrawBuffer(GL_NONE)
         glReadBuffer(GL_NONE)
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
@@ -450,19 +1183,9 @@ class GraphicsEngine:
 
     def setOnetimeUnifs(self):
 
-        projection_transform = pyrr.matrix44.create_perspective_projection(
-            fovy = 45, aspect = SCREEN_WIDTH / SCREEN_HEIGHT,
-            near = 0.1, far = 1000, dtype=np.float32
-        )
-
         shader = self.shaders[0]
         shader.use()
 
-        glUniformMatrix4fv(
-            glGetUniformLocation(shader.prog,"projection"),
-            1, GL_FALSE, projection_transform
-        )
-
         glUniform3fv(
             glGetUniformLocation(shader.prog,"ambient"), 
             1, np.array([0.1, 0.1, 0.1],dtype=np.float32))
@@ -489,82 +1212,194 @@ class GraphicsEngine:
         
         glUniform1i(
             glGetUniformLocation(shader.prog, "shadowMap"), 4)
-        
-        shader = self.shaders[1]
-        shader.use()
 
-        glUniformMatrix4fv(
-            glGetUniformLocation(shader.prog,"projection"),
-            1, GL_FALSE, projection_transform
-        )
+        glUniform1i(
+            glGetUniformLocation(shader.prog, "lightData"), 5)
+
+        glUniform1i(
+            glGetUniformLocation(shader.prog, "lightGrid"), 6)
+
+        glUniform1i(
+            glGetUniformLocation(shader.prog, "lightIndices"), 7)
 
     def getUnifsLocs(self):
         shader = self.shaders[0]
         shader.use()
 
-        shader.cacheSingleLoc(UNIFORM_TYPE["VIEW"], "view")
-        shader.cacheSingleLoc(UNIFORM_TYPE["CAMERA_POS"], "cameraPos")
-        shader.cacheSingleLoc(UNIFORM_TYPE["MODEL"], "model")
-        shader.cacheSingleLoc(UNIFORM_TYPE["LIGHT_SPTRANS"], "lightSpaceTransform")
-
-        for i in range(8):
-            shader.cacheMultiLoc(UNIFORM_TYPE["LIGHT_COLOR"], f"lights[{i}].color")
-            shader.cacheMultiLoc(UNIFORM_TYPE["LIGHT_POS"], f"lightPos[{i}]")
-            shader.cacheMultiLoc(UNIFORM_TYPE["LIGHT_STRENGTH"], f"lights[{i}].strength")
+        shader.cacheSingleLoc(UNIFORM_TYPE["MATERIAL_PACKED"], "material.packedMaps")
 
         shader = self.shaders[1]
         shader.use()
 
-        shader.cacheSingleLoc(UNIFORM_TYPE["MODEL"], "model")
-        shader.cacheSingleLoc(UNIFORM_TYPE["VIEW"], "view")
         shader.cacheSingleLoc(UNIFORM_TYPE["TINT"], "color")
 
         shader = self.shaders[2]
         shader.use()
 
         shader.cacheSingleLoc(UNIFORM_TYPE["LIGHT_SPTRANS"], "lightSpaceTransform")
-        shader.cacheSingleLoc(UNIFORM_TYPE["MODEL"], "model")
-
-    def render(self, scene):
-
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-        lightProjection = pyrr.matrix44.create_orthogonal_projection(-20, 20, -20, 20, 0.1, 100, dtype=np.float32)
-        lightPosition = np.array([-7, 3, 1], dtype=np.float32)
-        lookTarget = np.array([0,0,0], dtype=np.float32)
-        globalUp = np.array([0,1,0], dtype=np.float32)
-        lightView = pyrr.matrix44.create_look_at(lightPosition, lookTarget, globalUp, dtype=np.float32)
-        lightSpaceTransform = pyrr.matrix44.multiply(lightView, lightProjection)
 
+    #матрицы каскадов зависят от света и камеры; карта теней помечается устаревшей,
+    #только если они действительно изменились (мелкие сдвиги камеры гасит привязка к текселям)
+    def getCascadeTransforms(self, camera):
+        transforms = cascade_transforms(
+            camera, self.shadowLightTarget - self.shadowLightPosition, self.cascadeSplits, self.shadowMapRes, aspect=self.aspect)
+        if self.cascadeTransforms is None or not np.array_equal(transforms, self.cascadeTransforms):
+            self.cascadeTransforms = transforms
+            self.shadowDirty = True
+        return self.cascadeTransforms
+
+    def castsShadow(self, entityType):
+        return entityType != ENTITY_TYPE["POINTLIGHT"] and entityType != ENTITY_TYPE["FRUITPEARS"]
+
+    #ограничивающие сферы всех объектов сцены в мировых координатах - в порядке scene.transforms
+    def entityBounds(self, scene):
+        centers = np.empty((len(scene.transforms), 3), dtype=np.float32)
+        radii = np.empty(len(scene.transforms), dtype=np.float32)
+        for entityType, (start, end) in scene.transformRanges.items():
+            mesh = self.meshes[entityType]
+            centers[start:end] = mesh.boundsCenter
+            radii[start:end] = mesh.boundsRadius
+
+        transforms = scene.transforms
+        centers = np.einsum("ni,nij->nj", centers, transforms[:, :3, :3]) + transforms[:, 3, :3]
+        radii = radii * np.linalg.norm(transforms[:, :3, :3], axis=2).max(axis=1)
+        return (centers, radii)
+
+    #матрицы видимых экземпляров одного типа объектов
+    def visibleInstances(self, scene, entityType, visible):
+        start, end = scene.transformRanges[entityType]
+        mask = visible[start:end]
+        return scene.transforms[start:end][mask]
+
+    def renderShadowMap(self, scene, cascadeTransforms, bounds, slot=0):
         shader = self.shaders[2]
         shader.use()
 
         #glEnable(GL_CULL_FACE)
         #glCullFace(GL_BACK)
 
-
-        glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["LIGHT_SPTRANS"]), 1, GL_FALSE, lightSpaceTransform)
-
         glViewport(0, 0, self.shadowMapRes, self.shadowMapRes)
         glBindFramebuffer(GL_FRAMEBUFFER, self.depthMapFBO)
-        glClear(GL_DEPTH_BUFFER_BIT)
-
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, self.depthMap)
 
+        self.cullStats["shadowDrawn"] = self.cullStats["shadowCulled"] = 0
+
+        batch = self.shadowBatch if self.staticGeometry is not None else None
+        if batch is not None:
+            batch.begin()
+
+        #каждый каскад - отдельный слой массива, объекты отсекаются по его ортопроекции;
+        #с пакетом команды всех каскадов загружаются разом, на каскад - диапазон команд
+        cascadeDraws = []
+        for lightSpaceTransform in cascadeTransforms:
+            visible = spheres_in_frustum(frustum_planes(lightSpaceTransform), *bounds)
+
+            queue = self.shadowQueue
+            queue.clear()
+            for entityType in scene.entities:
+
+                if self.castsShadow(entityType):
+
+                    instances = self.visibleInstances(scene, entityType, visible)
+                    self.cullStats["shadowDrawn"] += len(instances)
+                    self.cullStats["shadowCulled"] += len(scene.entities[entityType]) - len(instances)
+                    if len(instances) > 0:
+                        queue.add(shader, None, self.meshes[entityType], instances)
+
+            items = queue.sorted()
+            if batch is not None:
+                first = len(batch.commands)
+                for _, _, mesh, instances in items:
+                    batch.add(mesh, instances)
+                cascadeDraws.append((first, len(items)))
+            else:
+                cascadeDraws.append(items)
+
+        if batch is not None:
+            batch.upload(slot)
+
+        profiler = self.profiler
+        for cascade, (lightSpaceTransform, draws) in enumerate(zip(cascadeTransforms, cascadeDraws)):
+            if profiler is not None:
+                profiler.begin(f"cascade{cascade}")
+            glFramebufferTextureLayer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, self.depthMap, 0, cascade)
+            glClear(GL_DEPTH_BUFFER_BIT)
+            glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["LIGHT_SPTRANS"]), 1, GL_FALSE, lightSpaceTransform)
+            GL_STATE.uniformUploads += 1
+
+            if batch is not None:
+                batch.draw(*draws)
+            else:
+                for _, _, mesh, instances in draws:
+                    mesh.setInstances(instances)
+                    mesh.draw()
+            if profiler is not None:
+                profiler.end()
+
+    #кадр рисуется в окно (0) или во framebuffer вне экрана, например OffscreenTarget; width, height -
+    #его размер в пикселях (у окна - glfw.get_framebuffer_size, на HiDPI больше размера окна).
+    #Вызывается и при изменении размера: пропорции меняют проекцию, кластеры света и каскады теней
+    def setRenderTarget(self, framebuffer, width, height):
+        self.targetFramebuffer = framebuffer
+        self.outputSize = (width, height)
+        if width / height != self.aspect:
+            self.aspect = width / height
+            self.projection = perspective_projection(self.aspect)
+            self.lightClusters.setProjection(self.projection)
+            self.cascadeTransforms = None
+        self.setRenderScale(self.renderScale)
+
+    #внутреннее разрешение - доля размера вывода (например 0.5 - вчетверо меньше пикселей)
+    def setRenderScale(self, scale):
+        self.renderScale = scale
+        width, height = self.outputSize
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if self.scaledTarget is not None and (size == self.outputSize or size != (self.scaledTarget.width, self.scaledTarget.height)):
+            self.scaledTarget.destroy()
+            self.scaledTarget = None
+        if size != self.outputSize and self.scaledTarget is None:
+            self.scaledTarget = OffscreenTarget(*size)
+        self.viewportSize = size
+
+    #растяжение кадра из scaledTarget на весь framebuffer вывода
+    def upscale(self):
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.scaledTarget.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.targetFramebuffer)
+        glBlitFramebuffer(
+            0, 0, *self.viewportSize, 0, 0, *self.outputSize, GL_COLOR_BUFFER_BIT, GL_LINEAR)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.targetFramebuffer)
 
-        for entityType, entities in scene.entities.items():
-
-            if entityType != ENTITY_TYPE["POINTLIGHT"] and entityType != ENTITY_TYPE["FRUITPEARS"]:
-
-                self.materials[entityType].use()
-                
-                for entity in entities:
-                    model = entity.getModelTransform()
-                    glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["MODEL"]), 1, GL_FALSE, model)  
-                    self.meshes[entityType].draw()
+    def render(self, scene):
 
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        #участки профилировщика: frame > transforms, shadow > cascadeN, uniforms, queue, depth > группы,
+        #lit > группы по типам объектов, upscale
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.beginFrame()
+
+        slot = self.frameFences.begin()
+
+        #матрицы моделей пересчитываются только у сдвинувшихся объектов; в буферы экземпляров
+        #попадают видимые в текущем проходе, буфер перезаписывается только при изменении набора
+        if profiler is not None:
+            profiler.begin("transforms")
+        changed = scene.updateTransforms()
+        bounds = self.entityBounds(scene)
+        if profiler is not None:
+            profiler.end()
+
+        cascadeTransforms = self.getCascadeTransforms(scene.camera)
+
+        #карта теней перерисовывается только если сдвинулись каскады или объект, отбрасывающий тень
+        if self.shadowDirty or any(self.castsShadow(entityType) for entityType in changed):
+            if profiler is not None:
+                profiler.begin("shadow")
+            self.renderShadowMap(scene, cascadeTransforms, bounds, slot)
+            if profiler is not None:
+                profiler.end()
+            self.shadowDirty = False
+            self.shadowStats["rendered"] += 1
+        else:
+            self.shadowStats["reused"] += 1
 
         #glDisable(GL_CULL_FACE)
         #glCullFace(GL_BACK)
@@ -574,44 +1409,91 @@ class GraphicsEngine:
             target = scene.camera.position + scene.camera.forwards,
             up = scene.camera.up, dtype=np.float32)
 
+        visible = spheres_in_frustum(frustum_planes(pyrr.matrix44.multiply(view_transform, self.projection)), *bounds)
+        self.cullStats["drawn"] = self.cullStats["culled"] = 0
+
         shader = self.shaders[0]
         shader.use()
 
-        glViewport(0, 0, SCREEN_WIDTH * 2, SCREEN_HEIGHT * 2)
-        glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["LIGHT_SPTRANS"]), 1, GL_FALSE, lightSpaceTransform)
-
-
-        glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["VIEW"]), 1, GL_FALSE, view_transform)
-        glUniform3fv(shader.fetchSingleLoc(UNIFORM_TYPE["CAMERA_POS"]), 1, scene.camera.position)     
-
-        for i, light in enumerate(scene.lights):
-            glUniform3fv(shader.fetchMultiLoc(UNIFORM_TYPE["LIGHT_POS"], i), 1, light.position)
-            glUniform3fv(shader.fetchMultiLoc(UNIFORM_TYPE["LIGHT_COLOR"], i), 1, light.color)
-            glUniform1f(shader.fetchMultiLoc(UNIFORM_TYPE["LIGHT_STRENGTH"], i), light.strength)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.targetFramebuffer if self.scaledTarget is None else self.scaledTarget.fbo)
+        glViewport(0, 0, *self.viewportSize)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
+        #данные кадра - одной загрузкой в буфер блока юниформ, источники света - по кластерам
+        if profiler is not None:
+            profiler.begin("uniforms")
+        clusters = self.lightClusters
+        clusters.assign(view_transform, scene.activeLights(), slot)
+        self.uniformBlocks.setFrame(view_transform, self.projection, scene.camera.position, self.cascadeSplits, cascadeTransforms)
+        self.uniformBlocks.setClusters(
+            clusters.grid, clusters.lightCount, self.viewportSize, clusters.sliceScale, clusters.sliceBias)
+        self.uniformBlocks.upload(slot)
+        if profiler is not None:
+            profiler.end()
+            profiler.begin("queue")
+
+        if self.debugOverdraw:
+            shader = self.shaders[1]
+
+        queue = self.litQueue
+        queue.clear()
         for entityType, entities in scene.entities.items():
 
-            glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["VIEW"]), 1, GL_FALSE, view_transform)
-
             if entityType != ENTITY_TYPE["POINTLIGHT"]:
-            
-                self.materials[entityType].use()
-
 
-                glActiveTexture(GL_TEXTURE4)
-                glBindTexture(GL_TEXTURE_2D, self.depthMap)
-                
-                for entity in entities:
-                    model = entity.getModelTransform()
-                    glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["MODEL"]), 1, GL_FALSE, model)  
-                    self.meshes[entityType].draw()
+                instances = self.visibleInstances(scene, entityType, visible)
+                self.cullStats["drawn"] += len(instances)
+                self.cullStats["culled"] += len(entities) - len(instances)
+                if len(instances) > 0:
+                    material = None if self.debugOverdraw else self.materials[entityType]
+                    queue.add(shader, material, self.meshes[entityType], instances)
+
+        #с проходом глубины освещение рисуется по материалам (лишние фрагменты отсекает GL_EQUAL),
+        #без него - от ближних объектов к дальним, чтобы закрытые отбрасывал ранний тест глубины
+        items = queue.frontToBack(scene.camera.position)
+        if profiler is not None:
+            profiler.end()
+        if self.depthPrepass:
+            if profiler is not None:
+                profiler.begin("depth")
+            self.renderDepthPrepass(items, slot)
+            if profiler is not None:
+                profiler.end()
+            items = queue.sorted()
+            glDepthFunc(GL_EQUAL)
+            glDepthMask(GL_FALSE)
+
+        if profiler is not None:
+            profiler.begin("lit")
+        if self.debugOverdraw:
+            self.beginOverdraw()
+        else:
+            GL_STATE.bindTexture(GL_TEXTURE_2D_ARRAY, self.depthMap, 4)
+            clusters.bind(5)
+
+        #материалы меняются только на границах групп очереди
+        if self.staticGeometry is not None:
+            self.drawBatched(self.litBatch, items, slot)
+        else:
+            material = None
+            for itemShader, itemMaterial, mesh, instances in items:
+                if profiler is not None:
+                    profiler.begin(self.meshNames[mesh])
+                itemShader.use()
+                if itemMaterial is not material:
+                    material = itemMaterial
+                    self.useMaterial(itemShader, material)
+
+                mesh.setInstances(instances)
+                mesh.draw()
+                if profiler is not None:
+                    profiler.end()
 
 
         # shader = self.shaders[1]
         # shader.use()
 
 
-        # glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["VIEW"]), 1, GL_FALSE, view_transform)
         # mesh = self.meshes[ENTITY_TYPE["POINTLIGHT"]]
 
         # for entity in scene.entities[ENTITY_TYPE["POINTLIGHT"]]:
@@ -619,27 +1501,629 @@ class GraphicsEngine:
 
         #     if entity.light.strength > 0:
             
-        #         model = entity.getModelTransform()
         #         glUniform3fv(shader.fetchSingleLoc(UNIFORM_TYPE["TINT"]), 1, entity.light.color)  
-        #         glUniformMatrix4fv(shader.fetchSingleLoc(UNIFORM_TYPE["MODEL"]), 1, GL_FALSE, model)  
+        #         mesh.setInstances([entity.getModelTransform()])
         #         mesh.draw()
 
 
-        glFlush()
+        if self.debugOverdraw:
+            self.endOverdraw()
+        if self.depthPrepass:
+            glDepthFunc(GL_LESS)
+            glDepthMask(GL_TRUE)
+
+        if profiler is not None:
+            profiler.end()
+
+        if self.scaledTarget is not None:
+            if profiler is not None:
+                profiler.begin("upscale")
+            self.upscale()
+            if profiler is not None:
+                profiler.end()
+
+        self.frameFences.end()
+        GL_STATE.endFrame()
+        if profiler is not None:
+            profiler.endFrame(GL_STATE.frameStats)
+
+    #только глубина, без записи цвета; items - элементы очереди от ближних к дальним
+    def renderDepthPrepass(self, items, slot=0):
+        shader = self.shaders[3]
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        items = [(shader, None, mesh, instances) for _, _, mesh, instances in items]
+        if self.staticGeometry is not None:
+            self.drawBatched(self.depthBatch, items, slot)
+        else:
+            shader.use()
+            for _, _, mesh, instances in items:
+                mesh.setInstances(instances)
+                mesh.draw()
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+
+    #фон отладки перерисовки - чёрный; шаг яркости задаётся цветом шейдера источника
+    def setDebugOverdraw(self, enabled):
+        self.debugOverdraw = enabled
+        if enabled:
+            glClearColor(0, 0, 0, 1)
+            shader = self.shaders[1]
+            shader.use()
+            glUniform3fv(shader.fetchSingleLoc(UNIFORM_TYPE["TINT"]), 1, np.full(3, OVERDRAW_STEP, dtype=np.float32))
+        else:
+            glClearColor(0.1, 0.2, 0.2, 1)
+            self.deleteOverdrawQueries()
+            self.overdraw = None
+
+    def deleteOverdrawQueries(self):
+        queries = self.overdrawFree + list(self.overdrawQueries)
+        if queries:
+            glDeleteQueries(len(queries), queries)
+        self.overdrawFree = []
+        self.overdrawQueries.clear()
+
+    def beginOverdraw(self):
+        glBlendFunc(GL_ONE, GL_ONE)
+        query = self.overdrawFree.pop() if self.overdrawFree else int(glGenQueries(1)[0])
+        glBeginQuery(GL_SAMPLES_PASSED, query)
+        self.overdrawQueries.append(query)
+
+    #результат читается, когда готов - без ожидания gpu
+    def endOverdraw(self):
+        glEndQuery(GL_SAMPLES_PASSED)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        while self.overdrawQueries and glGetQueryObjectiv(self.overdrawQueries[0], GL_QUERY_RESULT_AVAILABLE):
+            query = self.overdrawQueries.popleft()
+            self.overdraw = query_result(query) / (self.viewportSize[0] * self.viewportSize[1])
+            self.overdrawFree.append(query)
+
+    def useMaterial(self, shader, material):
+        material.use()
+        glUniform1i(shader.fetchSingleLoc(UNIFORM_TYPE["MATERIAL_PACKED"]), material.packed)
+        GL_STATE.uniformUploads += 1
+
+    #отсортированная очередь через пакет команд: подряд идущие элементы с одной программой
+    #и материалом (текстуры материала не индексируются в шейдере) - один glMultiDrawElementsIndirect
+    def drawBatched(self, batch, items, slot=0):
+        batch.begin()
+        groups = []
+        for shader, material, mesh, instances in items:
+            command = batch.add(mesh, instances)
+            if groups and groups[-1][0] is shader and groups[-1][1] is material:
+                groups[-1][3] += 1
+            else:
+                groups.append([shader, material, command, 1])
+        batch.upload(slot)
+
+        profiler = self.profiler
+        for shader, material, first, count in groups:
+            #группа - подряд идущие команды, команда - элемент очереди с тем же номером
+            if profiler is not None:
+                profiler.begin("+".join(self.meshNames[mesh] for _, _, mesh, _ in items[first:first + count]))
+            shader.use()
+            if material is not None:
+                self.useMaterial(shader, material)
+            batch.draw(first, count)
+            if profiler is not None:
+                profiler.end()
 
     def quit(self):
         for mesh in self.meshes.values():
             mesh.destroy()
         
         for material in self.materials.values():
-            material.destroy()
+            self.materialCache.release(material)
+        self.materialCache.clear()
+        self.textureCache.clear()
 
         for shader in self.shaders.values():
             shader.destroy()
 
+        self.deleteOverdrawQueries()
+        self.frameFences.destroy()
+        self.uniformBlocks.destroy()
+        self.lightClusters.destroy()
+
+        if self.staticGeometry is not None:
+            self.shadowBatch.destroy()
+            self.litBatch.destroy()
+            self.depthBatch.destroy()
+            self.staticGeometry.destroy()
+
+        if self.scaledTarget is not None:
+            self.scaledTarget.destroy()
+
+        GL_STATE.forgetTexture(self.depthMap)
         glDeleteTextures(1, [self.depthMap,])
         glDeleteFramebuffers(1, [self.depthMapFBO,])
 
+#буфер блока юниформ FrameData: данные кадра в numpy-массиве, за кадр - одна запись
+#в сегмент кольцевого буфера своего слота и glBindBufferRange на него
+class UniformBlocks:
+    def __init__(self, framesInFlight=1):
+        self.data = np.zeros(1, dtype=FRAME_DATA)
+        alignment = int(glGetIntegerv(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT))
+        self.ring = RingBuffer(GL_UNIFORM_BUFFER, FRAME_DATA.itemsize, framesInFlight, alignment)
+
+    def setFrame(self, view, projection, cameraPos, cascadeSplits, cascadeTransforms):
+        frame = self.data
+        frame["view"][0] = view
+        frame["projection"][0] = projection
+        frame["cameraPos"][0] = cameraPos
+        frame["cascadeCount"][0] = len(cascadeTransforms)
+        frame["cascadeSplits"][0, :len(cascadeSplits)] = cascadeSplits
+        frame["lightSpaceTransforms"][0, :len(cascadeTransforms)] = cascadeTransforms
+
+    #сетка кластеров освещения, число активных источников и параметры поиска кластера фрагмента
+    #(размер области вывода, слой глубины)
+    def setClusters(self, grid, lightCount, viewport, sliceScale, sliceBias):
+        self.data["clusterGrid"][0] = grid
+        self.data["lightCount"][0] = lightCount
+        self.data["clusterParams"][0] = (viewport[0], viewport[1], sliceScale, sliceBias)
+
+    #сегмент пишется каждый кадр: пропуск неизменных данных оставил бы привязанным сегмент другого слота,
+    #который может быть перезаписан, пока его читает кадр в полёте
+    def upload(self, slot):
+        offset = self.ring.write(slot, self.data.tobytes())
+        glBindBufferRange(GL_UNIFORM_BUFFER, UNIFORM_BLOCK_BINDING["FrameData"], self.ring.buffer, offset, FRAME_DATA.itemsize)
+        GL_STATE.uniformUploads += 1
+
+    def destroy(self):
+        self.ring.destroy()
+
+#кластерное освещение: источники распределяются по кластерам пирамиды видимости на cpu,
+#шейдер перебирает только источники своего кластера. Данные - в буферных текстурах:
+#lightData - LIGHT_DATA на источник, lightGrid - (смещение, число) на кластер, lightIndices - номера источников.
+#При поддержке glTexBufferRange данные кадра пишутся в кольцевые буферы по слотам кадров в полёте,
+#иначе буфер перевыделяется glBufferData
+class LightClusters:
+    FORMATS = {"lightData": GL_RGBA32F, "lightGrid": GL_RG32UI, "lightIndices": GL_R32UI}
+
+    def __init__(self, projection, grid=LIGHT_CLUSTER_GRID, near=CAMERA_NEAR, far=CAMERA_FAR, framesInFlight=1):
+        self.grid = grid
+        self.near = near
+        self.far = far
+        self.setProjection(projection)
+        #номер слоя фрагмента - floor(log(глубина) * sliceScale - sliceBias)
+        self.sliceScale = grid[2] / np.log(far / near)
+        self.sliceBias = self.sliceScale * np.log(near)
+
+        self.lightCount = 0
+        self.assignedCount = 0
+        self.framesInFlight = framesInFlight
+        self.useRings = texture_buffer_range_supported()
+        self.alignment = int(glGetIntegerv(GL_TEXTURE_BUFFER_OFFSET_ALIGNMENT)) if self.useRings else 1
+        self.rings: dict[str, RingBuffer] = {}
+        self.buffers: dict[str, int] = {}
+        self.textures: dict[str, int] = {}
+        self.uploaded: dict[str, bytes] = {}
+        for name, format in self.FORMATS.items():
+            self.textures[name] = glGenTextures(1)
+            if self.useRings:
+                self.rings[name] = RingBuffer(GL_TEXTURE_BUFFER, LIGHT_RING_SEGMENT, framesInFlight, self.alignment)
+                continue
+            self.buffers[name] = glGenBuffers(1)
+            glBindBuffer(GL_TEXTURE_BUFFER, self.buffers[name])
+            glBufferData(GL_TEXTURE_BUFFER, 16, None, GL_DYNAMIC_DRAW)
+            GL_STATE.bindTexture(GL_TEXTURE_BUFFER, self.textures[name])
+            glTexBuffer(GL_TEXTURE_BUFFER, format, self.buffers[name])
+
+    #границы кластеров в пространстве вида - при смене проекции (пропорций окна)
+    def setProjection(self, projection):
+        self.clusterMin, self.clusterMax = cluster_bounds(projection, self.grid, self.near, self.far)
+
+    #распределение источников по кластерам для матрицы вида; lights - массив LIGHT_DATA активных источников
+    def assign(self, view, lights, slot=0):
+        centers = lights["position"] @ view[:3, :3] + view[3, :3]
+        mask = spheres_in_clusters(self.clusterMin, self.clusterMax, centers, lights["radius"])
+        counts = mask.sum(axis=1)
+        grid = np.stack((np.cumsum(counts) - counts, counts), axis=1).astype(np.uint32)
+        #номера идут по кластерам, внутри кластера - по возрастанию
+        indices = np.nonzero(mask)[1].astype(np.uint32)
+
+        self.lightCount = len(lights)
+        self.assignedCount = len(indices)
+        self.upload("lightData", lights, slot)
+        self.upload("lightGrid", grid, slot)
+        self.upload("lightIndices", indices, slot)
+
+    def upload(self, name, array, slot):
+        data = array.tobytes()
+        if self.useRings:
+            ring = self.rings[name]
+            #сегмент мал - кольцо пересоздаётся вдвое больше; старый буфер gl удалит, когда его дочитают
+            if len(data) > ring.segmentSize:
+                ring.destroy()
+                ring = self.rings[name] = RingBuffer(
+                    GL_TEXTURE_BUFFER, max(len(data), 2 * ring.segmentSize), self.framesInFlight, self.alignment)
+            offset = ring.write(slot, data)
+            GL_STATE.bindTexture(GL_TEXTURE_BUFFER, self.textures[name])
+            glTexBufferRange(GL_TEXTURE_BUFFER, self.FORMATS[name], ring.buffer, offset, max(len(data), 16))
+            GL_STATE.uniformUploads += 1
+            return
+
+        if data == self.uploaded.get(name):
+            return
+        glBindBuffer(GL_TEXTURE_BUFFER, self.buffers[name])
+        glBufferData(GL_TEXTURE_BUFFER, max(len(data), 16), data or None, GL_DYNAMIC_DRAW)
+        self.uploaded[name] = data
+        GL_STATE.uniformUploads += 1
+
+    def bind(self, firstUnit):
+        for unit, name in enumerate(("lightData", "lightGrid", "lightIndices"), firstUnit):
+            GL_STATE.bindTexture(GL_TEXTURE_BUFFER, self.textures[name], unit)
+
+    def destroy(self):
+        for texture in self.textures.values():
+            GL_STATE.forgetTexture(texture)
+        glDeleteTextures(len(self.textures), list(self.textures.values()))
+        for ring in self.rings.values():
+            ring.destroy()
+        if self.buffers:
+            glDeleteBuffers(len(self.buffers), list(self.buffers.values()))
+
+#кольцевой буфер данных кадра: count сегментов, кадр пишет только в сегмент своего слота (FrameFences),
+#поэтому запись cpu не пересекается с чтением gpu кадров в полёте. При поддержке glBufferStorage буфер
+#отображён в память постоянно (persistent + coherent) и запись - просто копирование, иначе - отображение
+#сегмента без синхронизации (безопасно, слот уже освобождён забором)
+class RingBuffer:
+    def __init__(self, target, segmentSize, count, alignment=1):
+        self.target = target
+        self.segmentSize = -(-segmentSize // alignment) * alignment
+        self.size = self.segmentSize * count
+        self.persistent = buffer_storage_supported()
+
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(target, self.buffer)
+        if self.persistent:
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(target, self.size, None, flags)
+            pointer = glMapBufferRange(target, 0, self.size, flags)
+            self.memory = np.ctypeslib.as_array((ctypes.c_ubyte * self.size).from_address(pointer))
+        else:
+            glBufferData(target, self.size, None, GL_DYNAMIC_DRAW)
+
+    #запись данных в сегмент слота; возвращает смещение сегмента в буфере
+    def write(self, slot, data):
+        offset = slot * self.segmentSize
+        if self.persistent:
+            self.memory[offset:offset + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        elif data:
+            glBindBuffer(self.target, self.buffer)
+            pointer = glMapBufferRange(
+                self.target, offset, len(data), GL_MAP_WRITE_BIT | GL_MAP_UNSYNCHRONIZED_BIT | GL_MAP_INVALIDATE_RANGE_BIT)
+            ctypes.memmove(pointer, data, len(data))
+            glUnmapBuffer(self.target)
+        return offset
+
+    def destroy(self):
+        if self.persistent:
+            glBindBuffer(self.target, self.buffer)
+            glUnmapBuffer(self.target)
+            self.memory = None
+        glDeleteBuffers(1, (self.buffer,))
+
+#заборы кадров в полёте: кадр занимает слот, в конце ставит glFenceSync; прежде чем слот
+#достанется новому кадру, cpu ждёт, пока gpu закончит кадр, который занимал его count кадров назад
+class FrameFences:
+    def __init__(self, count):
+        self.fences = [None] * count
+        self.slot = 0
+        self.waitTime = 0.0
+
+    def begin(self):
+        fence = self.fences[self.slot]
+        if fence is not None:
+            start = time.perf_counter()
+            while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_TIMEOUT) == GL_TIMEOUT_EXPIRED:
+                pass
+            self.waitTime += time.perf_counter() - start
+            glDeleteSync(fence)
+            self.fences[self.slot] = None
+        return self.slot
+
+    def end(self):
+        self.fences[self.slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.slot = (self.slot + 1) % len(self.fences)
+
+    def destroy(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        self.fences = [None] * len(self.fences)
+
+#framebuffer вне экрана для рендеринга без окна: цвет RGBA8 и глубина - renderbuffer'ы
+class OffscreenTarget:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        self.colorBuffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.colorBuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.colorBuffer)
+        self.depthBuffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depthBuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depthBuffer)
+
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError(f"offscreen framebuffer incomplete: 0x{status:x}")
+
+    def destroy(self):
+        glDeleteFramebuffers(1, (self.fbo,))
+        glDeleteRenderbuffers(2, (self.colorBuffer, self.depthBuffer))
+
+#асинхронное чтение кадров: glReadPixels пишет в один из нескольких PBO и сразу возвращает управление,
+#буфер отображается в память только через count - 1 кадров, когда копирование уже завершено
+class FrameReader:
+    def __init__(self, width, height, count=3):
+        self.width = width
+        self.height = height
+        self.size = width * height * 4
+        self.pbos = [glGenBuffers(1) for _ in range(count)]
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending = deque()
+        self.next = 0
+
+    #копирование текущего кадра из framebuffer в свободный PBO; возвращает готовые кадры [(метка, пиксели)]
+    def request(self, framebuffer, tag):
+        ready = []
+        if len(self.pending) == len(self.pbos):
+            ready.append(self.collect())
+
+        pbo = self.pbos[self.next]
+        self.next = (self.next + 1) % len(self.pbos)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, framebuffer)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append((pbo, tag))
+        return ready
+
+    #все оставшиеся кадры
+    def flush(self):
+        return [self.collect() for _ in range(len(self.pending))]
+
+    #пиксели самого старого запроса (H, W, 4), строки сверху вниз
+    def collect(self):
+        pbo, tag = self.pending.popleft()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.size, GL_MAP_READ_BIT)
+        pixels = np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_ubyte)), (self.height, self.width, 4))[::-1].copy()
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        return (tag, pixels)
+
+    def destroy(self):
+        glDeleteBuffers(len(self.pbos), self.pbos)
+
+#64-битный результат запроса (наносекунды); обёртка PyOpenGL не умеет выделять GLuint64 под ответ
+def query_result(query):
+    result = ctypes.c_uint64()
+    raw_glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+    return result.value
+
+#текущее время gpu (нс) - то же, что записывает glQueryCounter, без ожидания команд в очереди
+def gl_timestamp():
+    result = ctypes.c_int64()
+    raw_glGetInteger64v(GL_TIMESTAMP, ctypes.byref(result))
+    return result.value
+
+#профилировщик кадра: вложенные участки begin/end с временем cpu (perf_counter) и gpu
+#(glQueryCounter GL_TIMESTAMP в начале и в конце - в отличие от GL_TIME_ELAPSED, вкладываются).
+#Запросы кадра читаются, только когда готовы - через кадр-другой, кадр gpu не ждёт.
+#Выключен (GraphicsEngine.profiler = None) - ни одного лишнего вызова
+class FrameProfiler:
+    def __init__(self, traceFrames=PROFILER_TRACE_FRAMES):
+        self.free = []
+        self.stack = []
+        self.scopes = []
+        self.frame = 0
+        self.pending = deque()
+        #кадры: {"frame", "scopes": [(имя, глубина, начало и конец cpu, начало и конец gpu)], "counters"}
+        self.results = deque(maxlen=traceFrames)
+        #общая точка отсчёта часов cpu и gpu - для одной шкалы в трассировке
+        self.cpuOrigin = time.perf_counter()
+        self.gpuOrigin = gl_timestamp()
+
+    def timestamp(self):
+        query = self.free.pop() if self.free else int(glGenQueries(1)[0])
+        glQueryCounter(query, GL_TIMESTAMP)
+        return query
+
+    def begin(self, name):
+        scope = [name, len(self.stack), time.perf_counter(), 0.0, self.timestamp(), None]
+        self.stack.append(scope)
+        self.scopes.append(scope)
+
+    def end(self):
+        scope = self.stack.pop()
+        scope[5] = self.timestamp()
+        scope[3] = time.perf_counter()
+
+    def beginFrame(self):
+        self.begin("frame")
+
+    #counters - счётчики кадра (GLState.frameStats)
+    def endFrame(self, counters):
+        self.end()
+        self.pending.append((self.frame, self.scopes, dict(counters)))
+        self.frame += 1
+        self.scopes = []
+        while self.pending and self.ready(self.pending[0][1]):
+            self.collect()
+
+    #последний запрос кадра - конец участка "frame"; запросы завершаются по порядку
+    def ready(self, scopes):
+        return glGetQueryObjectiv(scopes[0][5], GL_QUERY_RESULT_AVAILABLE)
+
+    def collect(self):
+        frame, scopes, counters = self.pending.popleft()
+        times = []
+        for name, depth, cpuStart, cpuEnd, gpuStart, gpuEnd in scopes:
+            times.append((
+                name, depth, cpuStart - self.cpuOrigin, cpuEnd - self.cpuOrigin,
+                (query_result(gpuStart) - self.gpuOrigin) / 1e9, (query_result(gpuEnd) - self.gpuOrigin) / 1e9))
+            self.free += (gpuStart, gpuEnd)
+        self.results.append({"frame": frame, "scopes": times, "counters": counters})
+
+    #дождаться и забрать все оставшиеся результаты
+    def flush(self):
+        while self.pending:
+            self.collect()
+
+    def reset(self):
+        self.flush()
+        self.results.clear()
+        self.frame = 0
+
+    #время участков одной глубины за кадр: {имя: (cpu мс, gpu мс)}, одноимённые складываются
+    @staticmethod
+    def scopeTimes(result, depth=1):
+        times = {}
+        for name, scopeDepth, cpuStart, cpuEnd, gpuStart, gpuEnd in result["scopes"]:
+            if scopeDepth == depth:
+                cpu, gpu = times.get(name, (0.0, 0.0))
+                times[name] = (cpu + (cpuEnd - cpuStart) * 1000, gpu + (gpuEnd - gpuStart) * 1000)
+        return times
+
+    #трассировка в формате Chrome trace event (chrome://tracing, Perfetto): участки cpu и gpu -
+    #две дорожки одного процесса, счётчики кадра - графики
+    def exportTrace(self, filename):
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "CPU"}},
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 1, "args": {"name": "GPU"}},
+        ]
+        for result in self.results:
+            for name, _, cpuStart, cpuEnd, gpuStart, gpuEnd in result["scopes"]:
+                args = {"frame": result["frame"]}
+                events.append({"name": name, "ph": "X", "pid": 0, "tid": 0,
+                               "ts": cpuStart * 1e6, "dur": (cpuEnd - cpuStart) * 1e6, "args": args})
+                events.append({"name": name, "ph": "X", "pid": 0, "tid": 1,
+                               "ts": gpuStart * 1e6, "dur": (gpuEnd - gpuStart) * 1e6, "args": args})
+            frameStart = result["scopes"][0][2] * 1e6
+            for name, value in result["counters"].items():
+                events.append({"name": name, "ph": "C", "pid": 0, "ts": frameStart, "args": {name: value}})
+
+        with open(filename, 'w') as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def destroy(self):
+        queries = self.free + [query for _, scopes, _ in self.pending for scope in scopes for query in scope[4:6]]
+        if queries:
+            glDeleteQueries(len(queries), queries)
+
+#отслеживание привязок gl (программа, VAO, текстуры по блокам): повторная привязка
+#того же объекта не отправляется в драйвер; счётчики отправленных и отброшенных привязок,
+#привязок текстур, вызовов отрисовки, треугольников и загрузок юниформ - за кадр
+class GLState:
+    COUNTERS = ("issued", "elided", "draws", "triangles", "textureBinds", "uniformUploads")
+
+    def __init__(self):
+        self.program = None
+        self.vao = None
+        self.activeUnit = None
+        self.textures: dict[tuple[int, int], int] = {}  #(блок, target) -> текстура
+        self.issued = 0
+        self.elided = 0
+        self.draws = 0
+        self.triangles = 0
+        self.textureBinds = 0
+        #glUniform*, запись в буфер блока юниформ или в текстурный буфер
+        self.uniformUploads = 0
+        self.frameStats = dict.fromkeys(self.COUNTERS, 0)
+
+    def useProgram(self, program):
+        if program == self.program:
+            self.elided += 1
+            return
+        glUseProgram(program)
+        self.program = program
+        self.issued += 1
+
+    def bindVertexArray(self, vao):
+        if vao == self.vao:
+            self.elided += 1
+            return
+        glBindVertexArray(vao)
+        self.vao = vao
+        self.issued += 1
+
+    def activeTexture(self, unit):
+        if unit == self.activeUnit:
+            self.elided += 1
+            return
+        glActiveTexture(GL_TEXTURE0 + unit)
+        self.activeUnit = unit
+        self.issued += 1
+
+    #unit=None - текущий активный блок
+    def bindTexture(self, target, texture, unit=None):
+        if unit is None:
+            unit = 0 if self.activeUnit is None else self.activeUnit
+        if self.textures.get((unit, target)) == texture:
+            self.elided += 1
+            return
+        self.activeTexture(unit)
+        glBindTexture(target, texture)
+        self.textures[(unit, target)] = texture
+        self.issued += 1
+        self.textureBinds += 1
+
+    #удалённый объект gl отвязывается драйвером, а его имя может достаться новому
+    def forgetTexture(self, texture):
+        self.textures = {key: bound for key, bound in self.textures.items() if bound != texture}
+
+    def forgetProgram(self, program):
+        if program == self.program:
+            self.program = None
+
+    def forgetVertexArray(self, vao):
+        if vao == self.vao:
+            self.vao = None
+
+    def endFrame(self):
+        self.frameStats = {name: getattr(self, name) for name in self.COUNTERS}
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+GL_STATE = GLState()
+
+#очередь отрисовки прохода: вызовы сортируются по программе, материалу и мешу,
+#чтобы одинаковое состояние шло подряд и повторные привязки отбрасывались
+class RenderQueue:
+    def __init__(self):
+        self.items = []
+
+    def clear(self):
+        self.items.clear()
+
+    def add(self, shader, material, mesh, instances):
+        self.items.append((shader, material, mesh, instances))
+
+    def sorted(self):
+        return sorted(self.items, key=lambda item: (item[0].prog, 0 if item[1] is None else id(item[1]), item[2].vao))
+
+    #элементы от ближних к дальним по расстоянию от камеры до центра ограничивающей сферы;
+    #экземпляры внутри элемента тоже сортируются - этот порядок сохраняется и для sorted()
+    def frontToBack(self, cameraPos):
+        keyed = []
+        for index, (shader, material, mesh, instances) in enumerate(self.items):
+            centers = mesh.boundsCenter @ instances[:, :3, :3] + instances[:, 3, :3]
+            distances = np.linalg.norm(centers - cameraPos, axis=1)
+            order = np.argsort(distances, kind="stable")
+            self.items[index] = (shader, material, mesh, instances[order])
+            keyed.append((distances[order[0]], index))
+        keyed.sort()
+        return [self.items[index] for _, index in keyed]
+
 class Shader:
     def __init__(self, vertexFilepath, fragmentFilepath):
         self.prog = self.createShader(vertexFilepath, fragmentFilepath)
@@ -654,7 +2138,19 @@ class Shader:
         with open(f"shaders/{fragmentFilepath}", 'r') as f:
             fragment_src = f.readlines()
 
-        shader = compileProgram(compileShader(vertex_src, GL_VERTEX_SHADER), compileShader(fragment_src, GL_FRAGMENT_SHADER))
+        #проверка программы (validate) идёт по текущему состоянию gl, пока все сэмплеры ещё на блоке 0,
+        #и ложно падает для сэмплеров разных типов (sampler2D и sampler2DArrayShadow) - поэтому отключена
+        vertex = compileShader(vertex_src, GL_VERTEX_SHADER)
+        fragment = compileShader(fragment_src, GL_FRAGMENT_SHADER)
+        shader = compileProgram(vertex, fragment, validate=False)
+        glDeleteShader(vertex)
+        glDeleteShader(fragment)
+
+        #блоки юниформ - на общие точки привязки буферов
+        for name, binding in UNIFORM_BLOCK_BINDING.items():
+            index = glGetUniformBlockIndex(shader, name)
+            if index != GL_INVALID_INDEX:
+                glUniformBlockBinding(shader, index, binding)
 
         #возврат дескриптора программы шейдера
         return shader
@@ -677,26 +2173,159 @@ class Shader:
         return self.multiUnifs[unifType][index]
     
     def use(self):
-        glUseProgram(self.prog)
+        GL_STATE.useProgram(self.prog)
     
     def destroy(self):
+        GL_STATE.forgetProgram(self.prog)
         glDeleteProgram(self.prog)
 
+#тангенты и битангенты всех треугольников сразу
+#positions - (N, 3), uvs - (N, 2), каждые три строки - один треугольник
+def face_orientations(positions, uvs):
+    pos = np.asarray(positions, dtype=np.float32).reshape(-1, 3, 3)
+    uv = np.asarray(uvs, dtype=np.float32).reshape(-1, 3, 2)
+
+    dPos1 = pos[:, 1] - pos[:, 0]
+    dPos2 = pos[:, 2] - pos[:, 0]
+    dUV1 = uv[:, 1] - uv[:, 0]
+    dUV2 = uv[:, 2] - uv[:, 0]
+    k = dUV1[:, 0] * dUV2[:, 1] - dUV2[:, 0] * dUV1[:, 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        den = 1 / k
+        tangent = den[:, None] * (dUV2[:, 1, None] * dPos1 - dUV1[:, 1, None] * dPos2)
+        bitangent = den[:, None] * (-dUV2[:, 0, None] * dPos1 + dUV1[:, 0, None] * dPos2)
+
+    #вырожденные uv (нулевая площадь) - базис строится по самому треугольнику
+    degenerate = (k == 0) | ~np.isfinite(tangent).all(axis=1) | ~np.isfinite(bitangent).all(axis=1)
+    if degenerate.any():
+        edge = dPos1[degenerate]
+        normal = np.cross(edge, dPos2[degenerate])
+        side = np.cross(normal, edge)
+
+        edgeLen = np.linalg.norm(edge, axis=1, keepdims=True)
+        sideLen = np.linalg.norm(side, axis=1, keepdims=True)
+        flat = (edgeLen[:, 0] == 0) | (sideLen[:, 0] == 0)
+        edgeLen[flat] = sideLen[flat] = 1
+        edge = edge / edgeLen
+        side = side / sideLen
+        edge[flat] = (1, 0, 0)
+        side[flat] = (0, 1, 0)
+
+        tangent[degenerate] = edge
+        bitangent[degenerate] = side
+
+    return (tangent, bitangent)
+
+#тангенты и битангенты для каждой вершины (N, 3)
+#smooth - усреднение по вершинам с одинаковыми позицией и текстурными координатами
+def vertex_orientations(positions, uvs, smooth=False):
+    tangent, bitangent = face_orientations(positions, uvs)
+    tangent = np.repeat(tangent, 3, axis=0)
+    bitangent = np.repeat(bitangent, 3, axis=0)
+
+    if smooth:
+        keys = np.hstack((
+            np.asarray(positions, dtype=np.float32).reshape(-1, 3),
+            np.asarray(uvs, dtype=np.float32).reshape(-1, 2)
+        ))
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        count = np.bincount(inverse).astype(np.float32)[:, None]
+
+        sums = np.zeros((count.shape[0], 6), dtype=np.float32)
+        np.add.at(sums, inverse, np.hstack((tangent, bitangent)))
+        sums /= count
+
+        tangent = sums[inverse, 0:3]
+        bitangent = sums[inverse, 3:6]
+
+    return (tangent, bitangent)
+
 class Mesh:
     def __init__(self):
         #x, y, z, s, t, nx, ny, nz, tangent, bitangent
         self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
+        GL_STATE.bindVertexArray(self.vao)
         self.vbo = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
 
+        #индексный буфер - только для индексированных мешей
+        self.ebo = None
+        self.indices = None
+        self.index_count = 0
+
+        #буфер экземпляров: матрица модели на каждый объект, атрибуты 5-8 (по столбцу)
+        self.instanceVbo = glGenBuffers(1)
+        self.instances = None
+        self.instance_count = 0
+        self.instanceTriangles = 0  #треугольников за вызов - для счётчика GLState
+        glBindBuffer(GL_ARRAY_BUFFER, self.instanceVbo)
+        for column in range(4):
+            glEnableVertexAttribArray(5 + column)
+            glVertexAttribPointer(5 + column, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(5 + column, 1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+
+    #загрузка индексов в EBO (VAO меша должен быть привязан)
+    def setIndices(self, indices):
+        self.indices = np.ascontiguousarray(indices, dtype=np.uint32)
+        self.index_count = len(self.indices)
+        self.ebo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
+
+    #загрузка матриц моделей экземпляров - массив (N, 4, 4); тот же набор повторно не загружается.
+    #Без пакетов multi-draw меш за кадр получает несколько наборов (каскады, глубина, освещение),
+    #поэтому буфер перевыделяется glBufferData, а не пишется в кольцо по слоту кадра
+    def setInstances(self, transforms):
+        transforms = np.ascontiguousarray(transforms, dtype=np.float32)
+        if self.instances is not None and np.array_equal(transforms, self.instances):
+            return
+        self.instances = transforms.copy()
+        self.instance_count = len(transforms)
+        self.instanceTriangles = (self.index_count if self.ebo is not None else self.vertex_count) // 3 * self.instance_count
+        glBindBuffer(GL_ARRAY_BUFFER, self.instanceVbo)
+        glBufferData(GL_ARRAY_BUFFER, transforms.nbytes, transforms, GL_DYNAMIC_DRAW)
+
+    #ограничивающие объёмы в координатах модели: AABB и сфера вокруг его центра
+    def setBounds(self, vertices, stride=14):
+        positions = np.asarray(vertices, dtype=np.float32).reshape(-1, stride)[:, 0:3]
+        self.boundsMin = positions.min(axis=0)
+        self.boundsMax = positions.max(axis=0)
+        self.boundsCenter = (self.boundsMin + self.boundsMax) / 2
+        self.boundsRadius = float(np.linalg.norm(positions - self.boundsCenter, axis=1).max())
+
+    #все экземпляры меша - одним вызовом отрисовки
     def draw(self):
-        glBindVertexArray(self.vao)
-        glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
+        if self.instance_count == 0:
+            return
+        GL_STATE.bindVertexArray(self.vao)
+        if self.ebo is not None:
+            glDrawElementsInstanced(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, None, self.instance_count)
+        else:
+            glDrawArraysInstanced(GL_TRIANGLES, 0, self.vertex_count, self.instance_count)
+        GL_STATE.draws += 1
+        GL_STATE.triangles += self.instanceTriangles
+
+    #память под геометрию: развёрнутые треугольники против индексированного варианта
+    def memoryStats(self):
+        stride = 56
+        corners = self.index_count if self.ebo is not None else self.vertex_count
+        used = self.vertex_count * stride + self.index_count * 4
+        return {
+            "corners": corners,
+            "vertices": self.vertex_count,
+            "bytes_before": corners * stride,
+            "bytes_after": used,
+        }
 
     def destroy(self):
+        GL_STATE.forgetVertexArray(self.vao)
         glDeleteVertexArrays(1, (self.vao,))
-        glDeleteBuffers(1, (self.vbo,))
+        glDeleteBuffers(2, (self.vbo, self.instanceVbo))
+        if self.ebo is not None:
+            glDeleteBuffers(1, (self.ebo,))
 
 class PlaneMesh(Mesh):
     def __init__(self, w, h, k):
@@ -714,25 +2343,10 @@ class PlaneMesh(Mesh):
 
         self.vertex_count = len(vertices) // 8
 
-        self.vertices = []
-        t = b = 0
-        for i in range(self.vertex_count):
-            m = i * 8
-            if i % 3 == 0:
-                (t, b) = self.get_face_orientation(
-                    [[vertices[j] for j in range(m, m + 3)], [vertices[j] for j in range(m + 3, m + 5)]],
-                    [[vertices[j] for j in range(m + 8, m + 11)], [vertices[j] for j in range(m + 11, m + 13)]],
-                    [[vertices[j] for j in range(m + 16, m + 19)], [vertices[j] for j in range(m + 19, m + 21)]])
-            for j in range(8):
-                self.vertices.append(vertices[m + j])
-
-            for element in t:
-                self.vertices.append(element)
-
-            for element in b:
-                self.vertices.append(element)
-
-        self.vertices = np.array(self.vertices, dtype=np.float32)   #тип важен для правильного распознавания OpenGl
+        vertices = np.array(vertices, dtype=np.float32).reshape(-1, 8)
+        tangent, bitangent = vertex_orientations(vertices[:, 0:3], vertices[:, 3:5])
+        self.vertices = np.hstack((vertices, tangent, bitangent)).reshape(-1)
+        self.setBounds(self.vertices)
 
         glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
 
@@ -762,36 +2376,265 @@ class PlaneMesh(Mesh):
         glEnableVertexAttribArray(4)
         glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(44))
 
-    def get_face_orientation(self, a, b, c):
-        
-        pos1 = np.array(a[0], dtype=np.float32)
-        uv1 = np.array(a[1], dtype=np.float32)
-
-        pos2 = np.array(b[0], dtype=np.float32)
-        uv2 = np.array(b[1], dtype=np.float32)
-
-        pos3 = np.array(c[0], dtype=np.float32)
-        uv3 = np.array(c[1], dtype=np.float32)
-
-        dPos1 = pos2 - pos1
-        dPos2 = pos3 - pos1
-        dUV1 = uv2 - uv1
-        dUV2 = uv3 - uv1
-
-        den = 1 / (dUV1[0] * dUV2[1] - dUV2[0] * dUV1[1])
-        tangent = [den * (dUV2[1] * dPos1[i] - dUV1[1] * dPos2[i]) for i in range(3)]
-        bitangent = [den * (-dUV2[0] * dPos1[i] + dUV1[0] * dPos2[i]) for i in range(3)]
-
-        return (tangent, bitangent)
+#чтение записей одного типа (v, vt, vn) в массив (N, width)
+def read_obj_records(lines, kind, width):
+    values = np.fromstring(" ".join(lines).replace(kind + " ", " "), dtype=np.float64, sep=" ")
+    if values.size == len(lines) * width:
+        return values.reshape(-1, width)
+
+    #записи разной длины (например, vt u v w) - разбор по строкам
+    tokens = [word for line in lines for word in line.split()[1:width + 1]]
+    return np.array(tokens, dtype=np.float64).reshape(-1, width)
+
+#загрузка меша (сетки) из obj файла целиком, без построчного разбора
+def load_obj_mesh(filename, smoothTangents=False):
+    with open(filename, 'r') as file:
+        lines = file.read().splitlines()
+
+    records = {"v": [], "vt": [], "vn": [], "f": []}
+    for line in lines:
+        kind = line.partition(" ")[0]
+        if kind in records:
+            records[kind].append(line)
+
+    v = read_obj_records(records["v"], "v", 3).astype(np.float32)
+    vt = read_obj_records(records["vt"], "vt", 2).astype(np.float32)
+    vn = read_obj_records(records["vn"], "vn", 3).astype(np.float32)
+
+    #индексы углов граней - v/vt/vn, в каждом углу по два "/"
+    faces = records["f"]
+    corner_counts = np.array([line.count("/") // 2 for line in faces], dtype=np.int64)
+    corners = " ".join(faces).replace("f ", " ").replace("/", " ")
+    corners = np.fromstring(corners, dtype=np.int64, sep=" ").reshape(-1, 3) - 1
+
+    #разбиение граней веером на треугольники (1, 2 + i, 3 + i)
+    triangle_counts = np.maximum(corner_counts - 2, 0)
+    face_starts = np.cumsum(corner_counts) - corner_counts
+    first = np.repeat(face_starts, triangle_counts)
+    i = np.arange(first.size) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+    triangles = np.stack((first, first + 1 + i, first + 2 + i), axis=1).reshape(-1)
+    corners = corners[triangles]
+
+    #x, y, z, s, t, nx, ny, nz, tangent, bitangent
+    vertices = np.empty((corners.shape[0], 14), dtype=np.float32)
+    vertices[:, 0:3] = v[corners[:, 0]]
+    vertices[:, 3:5] = vt[corners[:, 1]]
+    vertices[:, 5:8] = vn[corners[:, 2]]
+
+    #тангент и битангент
+    vertices[:, 8:11], vertices[:, 11:14] = vertex_orientations(vertices[:, 0:3], vertices[:, 3:5], smoothTangents)
+
+    return vertices.reshape(-1)
+
+#ключ записи кэша - по пути к файлу и параметрам загрузки
+def mesh_cache_paths(filename, options):
+    key = f"{os.path.abspath(filename)}|{options}"
+    name = hashlib.sha1(key.encode()).hexdigest()
+    base = os.path.join(MESH_CACHE_DIR, name)
+    return (base + ".json", base + ".npy", base + "_idx.npy")
+
+def file_content_hash(filename):
+    with open(filename, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+#загрузка obj через кэш: при попадании блоб отображается в память без разбора текста
+#запись устаревает при изменении содержимого файла (размер и mtime проверяются первыми)
+#возвращает (вершины, индексы), индексы - None для неиндексированного меша
+def load_cached_obj_mesh(filename, smoothTangents=False, indexed=False, optimizeCache=False):
+    options = f"s{int(smoothTangents)}i{int(indexed)}o{int(indexed and optimizeCache)}"
+    indexPath, blobPath, indicesPath = mesh_cache_paths(filename, options)
+    stat = os.stat(filename)
+
+    #обрезанная или испорченная запись кэша - промах, меш собирается заново из obj
+    entry = None
+    if os.path.exists(indexPath) and os.path.exists(blobPath):
+        try:
+            with open(indexPath, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            entry = None
+        if not isinstance(entry, dict) or any(key not in entry for key in MESH_CACHE_KEYS) \
+                or entry["version"] != MESH_CACHE_VERSION or (entry["index_count"] and not os.path.exists(indicesPath)):
+            entry = None
+
+    contentHash = None
+    if entry is not None:
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            #файл тронут - сверяем содержимое
+            contentHash = file_content_hash(filename)
+            if entry["hash"] != contentHash:
+                entry = None
+            else:
+                entry["size"] = stat.st_size
+                entry["mtime"] = stat.st_mtime_ns
+                write_mesh_cache_index(indexPath, entry)
+
+    if entry is not None:
+        try:
+            vertices = np.load(blobPath, mmap_mode='r')
+            indices = np.load(indicesPath, mmap_mode='r') if entry["index_count"] else None
+            if len(vertices) == entry["vertex_count"] * 14 and (indices is None or len(indices) == entry["index_count"]):
+                return (vertices, indices)
+        except (OSError, ValueError):
+            pass
+
+    if contentHash is None:
+        contentHash = file_content_hash(filename)
+    vertices, indices = load_obj_mesh(filename, smoothTangents), None
+    if indexed:
+        vertices, indices = build_indexed_mesh(vertices, optimizeCache)
+
+    os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+    if os.path.exists(indexPath):
+        os.remove(indexPath)
+    save_mesh_cache_blob(blobPath, vertices)
+    if indices is not None:
+        save_mesh_cache_blob(indicesPath, indices)
+    write_mesh_cache_index(indexPath, {
+        "version": MESH_CACHE_VERSION,
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": contentHash,
+        "options": options,
+        "vertex_count": len(vertices) // 14,
+        "index_count": len(indices) if indices is not None else 0,
+    })
+
+    return (vertices, indices)
+
+def save_mesh_cache_blob(blobPath, data):
+    tmpPath = blobPath[:-len(".npy")] + ".tmp.npy"
+    np.save(tmpPath, data)
+    os.replace(tmpPath, blobPath)
+
+def write_mesh_cache_index(indexPath, entry):
+    tmpPath = indexPath + ".tmp"
+    with open(tmpPath, 'w') as file:
+        json.dump(entry, file)
+    os.replace(tmpPath, indexPath)
+
+#объединение одинаковых вершин (v, vt, vn, tangent, bitangent) - вершины и индексы uint32
+def index_vertices(vertices, stride=14):
+    rows = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1, stride)
+    keys = rows.view(np.dtype((np.void, rows.itemsize * stride))).reshape(-1)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    #порядок вершин - по первому появлению в исходном буфере
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(order.size)
+
+    unique = rows[first[order]].reshape(-1)
+    indices = remap[inverse.reshape(-1)].astype(np.uint32)
+    return (unique, indices)
+
+#индексированный вариант меша; если объединять почти нечего (плоские тангенты
+#у каждого треугольника свои), индексы только добавят памяти - тогда None
+def build_indexed_mesh(vertices, optimizeCache=False):
+    unique, indices = index_vertices(vertices)
+    if unique.nbytes + indices.nbytes >= np.asarray(vertices).nbytes:
+        return (vertices, None)
+    if optimizeCache:
+        unique, indices = optimize_vertex_cache(unique, indices)
+    return (unique, indices)
+
+#перестановка треугольников под кэш вершин после трансформации (Tipsify, Sander et al. 2007)
+#вершины затем переупорядочиваются по первому использованию
+def optimize_vertex_cache(vertices, indices, cacheSize=16, stride=14):
+    triangles = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+    vertexCount = len(vertices) // stride
+
+    #смежность вершина -> треугольники
+    owners = np.argsort(triangles.reshape(-1), kind="stable") // 3
+    counts = np.bincount(triangles.reshape(-1), minlength=vertexCount)
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    owners = owners.tolist()
+    tris = triangles.tolist()
+
+    live = counts.tolist()
+    cacheTime = [0] * vertexCount
+    emitted = [False] * len(tris)
+    deadEnd = []
+    output = []
+    stamp = cacheSize + 1
+    cursor = 1
+    fan = 0 if vertexCount else -1
+
+    while fan >= 0:
+        candidates = []
+        for t in owners[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            for v in tris[t]:
+                output.append(v)
+                deadEnd.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if stamp - cacheTime[v] > cacheSize:
+                    cacheTime[v] = stamp
+                    stamp += 1
+            emitted[t] = True
+
+        #следующая вершина - из кэша с наибольшим "возрастом", иначе тупиковая
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if stamp - cacheTime[v] + 2 * live[v] <= cacheSize:
+                    priority = stamp - cacheTime[v]
+                if priority > best:
+                    best = priority
+                    fan = v
+
+        while fan == -1 and deadEnd:
+            v = deadEnd.pop()
+            if live[v] > 0:
+                fan = v
+
+        while fan == -1 and cursor < vertexCount:
+            if live[cursor] > 0:
+                fan = cursor
+            cursor += 1
+
+    output = np.array(output, dtype=np.int64)
+
+    #вершины в порядке первого обращения
+    _, first = np.unique(output, return_index=True)
+    order = np.argsort(first)
+    used = np.unique(output)[order]
+    remap = np.empty(vertexCount, dtype=np.int64)
+    remap[used] = np.arange(used.size)
+
+    rows = np.asarray(vertices, dtype=np.float32).reshape(-1, stride)
+    return (rows[used].reshape(-1), remap[output].astype(np.uint32))
+
+#данные меша без обращений к opengl - можно вызывать из рабочих потоков
+def load_obj_mesh_data(filename, smoothTangents=False, useCache=True, indexed=False, optimizeCache=False):
+    if useCache:
+        return load_cached_obj_mesh(filename, smoothTangents, indexed, optimizeCache)
+
+    vertices, indices = load_obj_mesh(filename, smoothTangents), None
+    if indexed:
+        vertices, indices = build_indexed_mesh(vertices, optimizeCache)
+    return (vertices, indices)
 
 class ObjMesh(Mesh):
-    def __init__(self, filename):
+    def __init__(self, filename, smoothTangents=False, useCache=True, indexed=False, optimizeCache=False, loader=None):
         super().__init__()
 
         #x, y, z, s, t, nx, ny, nz, tangent, bitangent
-        self.vertices = self.loadMesh(filename)
+        if loader is not None:
+            vertices, indices = loader.takeMesh(filename, smoothTangents, useCache, indexed, optimizeCache)
+        else:
+            vertices, indices = load_obj_mesh_data(filename, smoothTangents, useCache, indexed, optimizeCache)
+
+        self.vertices = vertices
         self.vertex_count = len(self.vertices) // 14
-        self.vertices = np.array(self.vertices, dtype=np.float32)
+        self.setBounds(self.vertices)
+        if indices is not None:
+            self.setIndices(indices)
 
         glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
 
@@ -815,160 +2658,568 @@ class ObjMesh(Mesh):
         glEnableVertexAttribArray(4)
         glVertexAttribPointer(4, 3, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(44))
 
-    #загрузка меша (сетки) из obj файла
-    def loadMesh(self, filename):
-        v = []
-        vt = []
-        vn = []
-
+GL_CONTEXT_VERSION = None
+
+def gl_version():
+    global GL_CONTEXT_VERSION
+    if GL_CONTEXT_VERSION is None:
+        GL_CONTEXT_VERSION = (int(glGetIntegerv(GL_MAJOR_VERSION)), int(glGetIntegerv(GL_MINOR_VERSION)))
+    return GL_CONTEXT_VERSION
+
+GL_EXTENSION_NAMES = None
+
+#набор расширений контекста собирается один раз
+def gl_extension_supported(name):
+    global GL_EXTENSION_NAMES
+    if GL_EXTENSION_NAMES is None:
+        GL_EXTENSION_NAMES = frozenset(
+            glGetStringi(GL_EXTENSIONS, i).decode() for i in range(glGetIntegerv(GL_NUM_EXTENSIONS)))
+    return name in GL_EXTENSION_NAMES
+
+BUFFER_STORAGE_SUPPORTED = None
+
+#постоянно отображённые буферы (glBufferStorage, OpenGL 4.4 или GL_ARB_buffer_storage)
+def buffer_storage_supported():
+    global BUFFER_STORAGE_SUPPORTED
+    if BUFFER_STORAGE_SUPPORTED is None:
+        BUFFER_STORAGE_SUPPORTED = (gl_version() >= (4, 4) or gl_extension_supported("GL_ARB_buffer_storage")) \
+            and bool(glBufferStorage)
+    return BUFFER_STORAGE_SUPPORTED
+
+TEXTURE_BUFFER_RANGE_SUPPORTED = None
+
+#буферная текстура на часть буфера (glTexBufferRange, OpenGL 4.3 или GL_ARB_texture_buffer_range)
+def texture_buffer_range_supported():
+    global TEXTURE_BUFFER_RANGE_SUPPORTED
+    if TEXTURE_BUFFER_RANGE_SUPPORTED is None:
+        TEXTURE_BUFFER_RANGE_SUPPORTED = (gl_version() >= (4, 3) or gl_extension_supported("GL_ARB_texture_buffer_range")) \
+            and bool(glTexBufferRange)
+    return TEXTURE_BUFFER_RANGE_SUPPORTED
+
+MULTI_DRAW_INDIRECT_SUPPORTED = None
+
+def multi_draw_indirect_supported():
+    global MULTI_DRAW_INDIRECT_SUPPORTED
+    if MULTI_DRAW_INDIRECT_SUPPORTED is None:
+        MULTI_DRAW_INDIRECT_SUPPORTED = gl_version() >= (4, 3) and bool(glMultiDrawElementsIndirect)
+    return MULTI_DRAW_INDIRECT_SUPPORTED
+
+#вершинные атрибуты общего формата (56 байт): номер, число компонент, смещение
+VERTEX_ATTRIBUTES = ((0, 3, 0), (1, 2, 12), (2, 3, 20), (3, 3, 32), (4, 3, 44))
+
+#DrawElementsIndirectCommand
+DRAW_ELEMENTS_COMMAND = np.dtype([
+    ("count", "<u4"), ("instanceCount", "<u4"), ("firstIndex", "<u4"), ("baseVertex", "<i4"), ("baseInstance", "<u4")
+])
+
+#геометрия всех мешей в одном VBO и одном EBO; неиндексированные меши получают индексы 0..n-1
+#ranges[mesh] - (первый индекс, число индексов, базовая вершина)
+class StaticGeometry:
+    def __init__(self, meshes):
+        self.ranges: dict[Mesh, tuple[int, int, int]] = {}
         vertices = []
+        indices = []
+        firstIndex = 0
+        baseVertex = 0
+        for mesh in meshes:
+            meshIndices = mesh.indices if mesh.indices is not None else np.arange(mesh.vertex_count, dtype=np.uint32)
+            self.ranges[mesh] = (firstIndex, len(meshIndices), baseVertex)
+            vertices.append(np.asarray(mesh.vertices, dtype=np.float32))
+            indices.append(meshIndices)
+            firstIndex += len(meshIndices)
+            baseVertex += mesh.vertex_count
+
+        self.vertices = np.concatenate(vertices)
+        self.indices = np.concatenate(indices).astype(np.uint32)
 
-        with open(filename, 'r') as file:
-            line = file.readline()
-            while line:
-                words = line.split(" ")
-                if words[0] == "v":
-                    v.append(self.read_vertex_data(words))
-                elif words[0] == "vt":
-                    vt.append(self.read_texcoord_data(words))
-                elif words[0] == "vn":
-                    vn.append(self.read_normal_data(words))
-                elif words[0] == "f":
-                    self.read_face_data(words, v, vt, vn, vertices)
-                line = file.readline()
-
-        return vertices
-    
-    #чтение вершины
-    def read_vertex_data(self, words):
-        return [
-            float(words[1]),
-            float(words[2]),
-            float(words[3])
-        ]
-    
-    #чтение координат текстуры
-    def read_texcoord_data(self, words):
-        return [
-            float(words[1]),
-            float(words[2])
-        ]
-
-    #чтение векторов нормали
-    def read_normal_data(self, words):
-        return [
-            float(words[1]),
-            float(words[2]),
-            float(words[3])
-        ]
-
-    #создание граней
-    def read_face_data(self, words, v, vt, vn, vertices):
-        
-        triangleCount = len(words) - 3
-
-        for i in range(triangleCount):
-            tangent, bitangent = self.get_face_orientation(words, 1, 2 + i, 3 + i, v, vt)
-
-            self.make_corner(words[1], v, vt, vn, vertices, tangent, bitangent)
-            self.make_corner(words[2 + i], v, vt, vn, vertices, tangent, bitangent)
-            self.make_corner(words[3 + i], v, vt, vn, vertices, tangent, bitangent)
-
-    def get_face_orientation(self, words, a, b, c, v, vt):
-        v_vt_vn = words[a].split("/")
-        pos1 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
-        uv1 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
-
-        v_vt_vn = words[b].split("/")
-        pos2 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
-        uv2 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
-
-        v_vt_vn = words[c].split("/")
-        pos3 = np.array(v[int(v_vt_vn[0]) - 1], dtype=np.float32)
-        uv3 = np.array(vt[int(v_vt_vn[1]) - 1], dtype=np.float32)
-
-        dPos1 = pos2 - pos1
-        dPos2 = pos3 - pos1
-        dUV1 = uv2 - uv1
-        dUV2 = uv3 - uv1
-        k = (dUV1[0] * dUV2[1] - dUV2[0] * dUV1[1])
-
-        den = 1 / k
-        tangent = [den * (dUV2[1] * dPos1[i] - dUV1[1] * dPos2[i]) for i in range(3)]
-        bitangent = [den * (-dUV2[0] * dPos1[i] + dUV1[0] * dPos2[i]) for i in range(3)]
-
-        return (tangent, bitangent)
-
-    #запись описания вершины
-    def make_corner(self, corner_description, v, vt, vn, vertices, tangent, bitangent):
-        v_vt_vn = corner_description.split("/")
-        if (v_vt_vn[0] != '\n'):
-            for element in v[int(v_vt_vn[0]) - 1]:
-                vertices.append(element)
-
-            for element in vt[int(v_vt_vn[1]) - 1]:
-                vertices.append(element)
-
-            for element in vn[int(v_vt_vn[2]) - 1]:
-                vertices.append(element)
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices, GL_STATIC_DRAW)
+        self.ebo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
 
-            for element in tangent:
-                vertices.append(element)
+    def destroy(self):
+        glDeleteBuffers(2, (self.vbo, self.ebo))
+
+#пакет отрисовки одного прохода поверх StaticGeometry: свой VAO и кольцевые буферы экземпляров и команд
+#(сегмент на слот кадра в полёте, как у UniformBlocks). Матрица модели берётся из буфера экземпляров
+#по baseInstance команды, поэтому сегмент слота выбирается сдвигом baseInstance, шейдеры не меняются
+class IndirectBatch:
+    def __init__(self, geometry, framesInFlight=1):
+        self.geometry = geometry
+        self.framesInFlight = framesInFlight
+        self.commands = []
+        self.instances = []
+        self.instanceCount = 0
+        self.commandOffset = 0
+        self.triangleOffsets = [0]
 
-            for element in bitangent:
-                vertices.append(element)
+        self.vao = glGenVertexArrays(1)
+        GL_STATE.bindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, geometry.vbo)
+        for location, size, offset in VERTEX_ATTRIBUTES:
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, 56, ctypes.c_void_p(offset))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, geometry.ebo)
+
+        #сегменты экземпляров выровнены по матрице - смещение сегмента делится на 64 без остатка
+        self.instanceRing = RingBuffer(GL_ARRAY_BUFFER, BATCH_RING_SEGMENT, framesInFlight, 64)
+        self.commandRing = RingBuffer(GL_DRAW_INDIRECT_BUFFER, BATCH_RING_SEGMENT, framesInFlight, DRAW_ELEMENTS_COMMAND.itemsize)
+        self.bindInstances()
+
+    def bindInstances(self):
+        GL_STATE.bindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instanceRing.buffer)
+        for column in range(4):
+            glEnableVertexAttribArray(5 + column)
+            glVertexAttribPointer(5 + column, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(5 + column, 1)
+
+    def begin(self):
+        self.commands.clear()
+        self.instances.clear()
+        self.instanceCount = 0
+
+    #команда на все экземпляры меша; возвращает её номер
+    def add(self, mesh, instances):
+        firstIndex, count, baseVertex = self.geometry.ranges[mesh]
+        self.commands.append((count, len(instances), firstIndex, baseVertex, self.instanceCount))
+        self.instances.append(instances)
+        self.instanceCount += len(instances)
+        return len(self.commands) - 1
+
+    #сегмент мал - кольцо пересоздаётся вдвое больше; старый буфер gl удалит, когда его дочитают
+    def growRing(self, ring, size, alignment):
+        ring.destroy()
+        return RingBuffer(ring.target, max(size, 2 * ring.segmentSize), self.framesInFlight, alignment)
+
+    #команды и матрицы пишутся в сегменты слота каждый кадр: пропуск неизменных данных оставил бы
+    #в работе сегмент другого слота, который перезапишет следующий кадр, пока его читает кадр в полёте
+    def upload(self, slot=0):
+        commands = np.array(self.commands, dtype=DRAW_ELEMENTS_COMMAND)
+        instances = np.concatenate(self.instances).astype(np.float32) if self.instances else np.zeros((0, 4, 4), dtype=np.float32)
+
+        if instances.nbytes > self.instanceRing.segmentSize:
+            self.instanceRing = self.growRing(self.instanceRing, instances.nbytes, 64)
+            self.bindInstances()
+        if commands.nbytes > self.commandRing.segmentSize:
+            self.commandRing = self.growRing(self.commandRing, commands.nbytes, DRAW_ELEMENTS_COMMAND.itemsize)
+
+        commands["baseInstance"] += self.instanceRing.write(slot, instances.tobytes()) // 64
+        self.commandOffset = self.commandRing.write(slot, commands.tobytes())
+        #треугольники команд нарастающим итогом: на вызов - одно вычитание
+        self.triangleOffsets = [0] + np.cumsum(
+            commands["count"].astype(np.int64) // 3 * commands["instanceCount"]).tolist()
+
+    #команды first..first+count-1 - одним вызовом
+    def draw(self, first, count):
+        if count == 0:
+            return
+        GL_STATE.bindVertexArray(self.vao)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.commandRing.buffer)
+        glMultiDrawElementsIndirect(
+            GL_TRIANGLES, GL_UNSIGNED_INT, ctypes.c_void_p(self.commandOffset + first * DRAW_ELEMENTS_COMMAND.itemsize),
+            count, DRAW_ELEMENTS_COMMAND.itemsize)
+        GL_STATE.draws += 1
+        GL_STATE.triangles += self.triangleOffsets[first + count] - self.triangleOffsets[first]
 
     def destroy(self):
+        GL_STATE.forgetVertexArray(self.vao)
         glDeleteVertexArrays(1, (self.vao,))
-        glDeleteBuffers(1, (self.vbo,))
+        self.instanceRing.destroy()
+        self.commandRing.destroy()
+
+#параметры сэмплера - wrap s, wrap t, min filter, mag filter
+DEFAULT_SAMPLER = (GL_REPEAT, GL_REPEAT, GL_NEAREST_MIPMAP_LINEAR, GL_LINEAR)
 
 class Material:
-    def __init__(self, unit, textureType):
+    def __init__(self, unit, textureType, sampler=DEFAULT_SAMPLER):
         self.texture = glGenTextures(1)
         self.unit = unit
         self.textureType = textureType
+        self.sampler = sampler
 
-        glBindTexture(textureType, self.texture)
-        glTexParameteri(textureType, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(textureType, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        glTexParameteri(textureType, GL_TEXTURE_MIN_FILTER, GL_NEAREST_MIPMAP_LINEAR)
-        glTexParameteri(textureType, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        wrapS, wrapT, minFilter, magFilter = sampler
+        GL_STATE.bindTexture(textureType, self.texture)
+        glTexParameteri(textureType, GL_TEXTURE_WRAP_S, wrapS)
+        glTexParameteri(textureType, GL_TEXTURE_WRAP_T, wrapT)
+        glTexParameteri(textureType, GL_TEXTURE_MIN_FILTER, minFilter)
+        glTexParameteri(textureType, GL_TEXTURE_MAG_FILTER, magFilter)
 
-    def use(self):
-        glActiveTexture(GL_TEXTURE0 + self.unit)
-        glBindTexture(self.textureType, self.texture)
+    def use(self, unit=None):
+        GL_STATE.bindTexture(self.textureType, self.texture, self.unit if unit is None else unit)
 
     def destroy(self):
+        GL_STATE.forgetTexture(self.texture)
         glDeleteTextures(1, (self.texture,))
 
+#запечённые текстуры (.btex рядом с исходной картинкой, см. bake_textures.py):
+#заголовок, затем все mip-уровни, готовые к загрузке без декодирования
+BAKED_TEXTURE_EXT = ".btex"
+BAKED_TEXTURE_MAGIC = b"BTEX"
+BAKED_TEXTURE_VERSION = 1
+BAKED_TEXTURE_HEADER = struct.Struct("<4sIIIII")  #magic, версия, формат, ширина, высота, число уровней
+BAKED_TEXTURE_LEVEL = struct.Struct("<III")       #ширина, высота, размер данных
+
+#форматы: номер -> (название, внутренний формат, формат данных (None для сжатых), число каналов)
+TEXTURE_FORMATS = {
+    0: ("RGBA8", GL_RGBA8, GL_RGBA, 4),
+    1: ("R8", GL_R8, GL_RED, 1),
+    2: ("RG8", GL_RG8, GL_RG, 2),
+    3: ("BC1", GL_COMPRESSED_RGB_S3TC_DXT1_EXT, None, 4),
+    4: ("BC3", GL_COMPRESSED_RGBA_S3TC_DXT5_EXT, None, 4),
+    5: ("BC4", GL_COMPRESSED_RED_RGTC1, None, 1),
+    6: ("BC5", GL_COMPRESSED_RG_RGTC2, None, 2),
+}
+
+#перестановка каналов при выборке: серая карта в одном канале читается как RRR1,
+#два канала - две упакованные карты (ao + блики), читаются как есть
+TEXTURE_SWIZZLES = {
+    1: (GL_RED, GL_RED, GL_RED, GL_ONE),
+    2: (GL_RED, GL_GREEN, GL_ZERO, GL_ONE),
+    4: (GL_RED, GL_GREEN, GL_BLUE, GL_ALPHA),
+}
+
+#данные текстуры, готовые к загрузке: формат и список mip-уровней (ширина, высота, байты)
+#при одном уровне mip-цепочка строится на видеокарте
+class TextureImage:
+    def __init__(self, format, levels):
+        self.format = format
+        self.levels = levels
+        self.compressed = TEXTURE_FORMATS[format][2] is None
+
+        size = sum(len(data) for _, _, data in levels)
+        self.nbytes = size * 4 // 3 if len(levels) == 1 else size
+
+def baked_texture_path(filepath):
+    return os.path.splitext(filepath)[0] + BAKED_TEXTURE_EXT
+
+#чтение ровно size байт; оборванный файл - ValueError, как и неподдерживаемый
+def read_baked_bytes(file, size, filepath):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError(f"{filepath}: truncated baked texture")
+    return data
+
+def read_baked_texture(filepath):
+    with open(filepath, 'rb') as file:
+        magic, version, format, width, height, levelCount = BAKED_TEXTURE_HEADER.unpack(
+            read_baked_bytes(file, BAKED_TEXTURE_HEADER.size, filepath))
+        if magic != BAKED_TEXTURE_MAGIC or version != BAKED_TEXTURE_VERSION or format not in TEXTURE_FORMATS:
+            raise ValueError(f"{filepath}: unsupported baked texture")
+
+        levels = []
+        for _ in range(levelCount):
+            levelWidth, levelHeight, size = BAKED_TEXTURE_LEVEL.unpack(
+                read_baked_bytes(file, BAKED_TEXTURE_LEVEL.size, filepath))
+            levels.append((levelWidth, levelHeight, read_baked_bytes(file, size, filepath)))
+    return TextureImage(format, levels)
+
+#декодирование картинки без обращений к opengl - можно вызывать из рабочих потоков
+#если рядом лежит свежая запечённая версия, берётся она
+def decode_image(filepath, baked=True):
+    bakedPath = baked_texture_path(filepath)
+    if baked and os.path.exists(bakedPath):
+        if not os.path.exists(filepath) or os.path.getmtime(bakedPath) >= os.path.getmtime(filepath):
+            #оборванный или чужой .btex - промах, картинка читается из исходника рядом
+            try:
+                return read_baked_texture(bakedPath)
+            except (OSError, ValueError):
+                if bakedPath == filepath or not os.path.exists(filepath):
+                    raise
+
+    with Image.open(filepath, mode = 'r') as img:
+        img_width, img_height = img.size
+        img = img.convert("RGBA")
+        return TextureImage(0, [(img_width, img_height, img.tobytes())])
+
+#сжатые форматы, которые понимает текущий контекст (RGTC - в ядре с 3.0, S3TC - расширение)
+SUPPORTED_COMPRESSION = None
+
+def compression_supported(format):
+    global SUPPORTED_COMPRESSION
+    if SUPPORTED_COMPRESSION is None:
+        SUPPORTED_COMPRESSION = {5, 6}
+        if gl_extension_supported("GL_EXT_texture_compression_s3tc"):
+            SUPPORTED_COMPRESSION |= {3, 4}
+    return format in SUPPORTED_COMPRESSION
+
+#картинка текстуры для загрузки в текущий контекст: запечённая, если её формат поддерживается,
+#иначе - исходная картинка
+def load_texture_image(filepath, loader=None):
+    if loader is not None:
+        image = loader.takeImage(filepath)
+    else:
+        image = decode_image(filepath)
+
+    if image.compressed and not compression_supported(image.format):
+        image = decode_image(filepath, baked=False)
+    return image
+
 class Material2D(Material):
-    def __init__(self, filepath, unit):
-        super().__init__(unit, textureType = GL_TEXTURE_2D)
-        with Image.open(filepath, mode = 'r') as img:
-            img_width, img_height = img.size
-            img = img.convert("RGBA")
-            img_data = bytes(img.tobytes())
-            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img_width, img_height, 0, GL_RGBA, GL_UNSIGNED_BYTE, img_data)
-        glGenerateMipmap(GL_TEXTURE_2D)
-
-#материал - из нескольких текстур
-class Material3D(Material):
-    def __init__(self, filename, filetype, filetypeNRM):
-        self.textures: list[Material2D] = [
-            Material2D(f"gfx/{filename}/{filename}_COL.{filetype}", 0),
-            Material2D(f"gfx/{filename}/{filename}_AO.{filetype}", 1),
-            Material2D(f"gfx/{filename}/{filename}_NRM.{filetypeNRM}", 2),
-            Material2D(f"gfx/{filename}/{filename}_GLOSS.{filetype}", 3),
+    def __init__(self, filepath, unit, loader=None, sampler=DEFAULT_SAMPLER):
+        image = load_texture_image(filepath, loader)
+
+        self.filepath = filepath
+        self.cache = None
+        super().__init__(unit, GL_TEXTURE_2D, sampler)
+        self.upload(image)
+
+    def upload(self, image):
+        _, internalFormat, dataFormat, channels = TEXTURE_FORMATS[image.format]
+
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for level, (img_width, img_height, img_data) in enumerate(image.levels):
+            if image.compressed:
+                glCompressedTexImage2D(GL_TEXTURE_2D, level, internalFormat, img_width, img_height, 0, img_data)
+            else:
+                glTexImage2D(GL_TEXTURE_2D, level, internalFormat, img_width, img_height, 0, dataFormat, GL_UNSIGNED_BYTE, img_data)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+        glTexParameteriv(GL_TEXTURE_2D, GL_TEXTURE_SWIZZLE_RGBA, np.array(TEXTURE_SWIZZLES[channels], dtype=np.int32))
+        if len(image.levels) == 1:
+            glGenerateMipmap(GL_TEXTURE_2D)
+        else:
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(image.levels) - 1)
+
+        #память с учётом mip-уровней
+        self.size = image.nbytes
+
+    def use(self, unit=None):
+        #текстура под управлением кэша с лимитом памяти могла быть выгружена
+        if self.cache is not None:
+            self.cache.touch(self)
+        super().use(unit)
+
+    #выгрузка из видеопамяти с возможностью повторной загрузки из файла
+    def evict(self):
+        GL_STATE.forgetTexture(self.texture)
+        glDeleteTextures(1, (self.texture,))
+        self.texture = None
+
+    def reload(self):
+        Material.__init__(self, self.unit, self.textureType, self.sampler)
+        self.upload(load_texture_image(self.filepath))
+
+    def destroy(self):
+        if self.texture is not None:
+            super().destroy()
+            self.texture = None
+
+#упакованная текстура материала (bake_textures.py --materials): R - ao, G - блики, B - высота
+def packed_material_path(filename):
+    return f"gfx/{filename}/{filename}_PACKED{BAKED_TEXTURE_EXT}"
+
+#упакованную текстуру не из чего заменить исходной картинкой - она годится, только если контекст понимает её формат
+def packed_material_supported(filename):
+    filepath = packed_material_path(filename)
+    if not os.path.exists(filepath):
+        return False
+    #оборванный файл - тоже негодный, берутся отдельные карты AO/GLOSS
+    try:
+        with open(filepath, 'rb') as file:
+            header = file.read(BAKED_TEXTURE_HEADER.size)
+    except OSError:
+        return False
+    if len(header) != BAKED_TEXTURE_HEADER.size:
+        return False
+    magic, version, format, _, _, _ = BAKED_TEXTURE_HEADER.unpack(header)
+    if magic != BAKED_TEXTURE_MAGIC or version != BAKED_TEXTURE_VERSION or format not in TEXTURE_FORMATS:
+        return False
+    return TEXTURE_FORMATS[format][2] is not None or compression_supported(format)
+
+#файлы текстур материала: цвет, ambient occlusion, нормали, блики
+#если есть пригодная упакованная текстура - цвет, ao и блики вместе, нормали (три текстуры)
+def material_paths(filename, filetype, filetypeNRM, packed=True):
+    if packed and packed_material_supported(filename):
+        return [
+            f"gfx/{filename}/{filename}_COL.{filetype}",
+            packed_material_path(filename),
+            f"gfx/{filename}/{filename}_NRM.{filetypeNRM}",
         ]
 
+    return [
+        f"gfx/{filename}/{filename}_COL.{filetype}",
+        f"gfx/{filename}/{filename}_AO.{filetype}",
+        f"gfx/{filename}/{filename}_NRM.{filetypeNRM}",
+        f"gfx/{filename}/{filename}_GLOSS.{filetype}",
+    ]
+
+#материал - из нескольких текстур, номер текстуры в списке - номер текстурного блока
+class Material3D(Material):
+    def __init__(self, filename, filetype, filetypeNRM, loader=None, textureCache=None, sampler=DEFAULT_SAMPLER):
+        self.textureCache = textureCache
+        paths = material_paths(filename, filetype, filetypeNRM)
+        self.packed = len(paths) == 3
+
+        if textureCache is not None:
+            self.textures: list[Material2D] = [
+                textureCache.acquire(filepath, loader, sampler) for filepath in paths
+            ]
+        else:
+            self.textures: list[Material2D] = [
+                Material2D(filepath, unit, loader, sampler) for unit, filepath in enumerate(paths)
+            ]
+
     def use(self):
-        for texture in self.textures:
-            texture.use()
+        #все текстуры материала отмечаются разом, чтобы кэш не выгрузил одну ради другой
+        if self.textureCache is not None and self.textureCache.budget is not None:
+            self.textureCache.touch(*self.textures)
+        for unit, texture in enumerate(self.textures):
+            Material.use(texture, unit)
 
     def destroy(self):
         for texture in self.textures:
+            if self.textureCache is not None:
+                self.textureCache.release(texture)
+            else:
+                texture.destroy()
+
+#общие текстуры: одна gl текстура на файл и параметры сэмплера, со счётчиком ссылок
+#при заданном budget (байты) давно не использованные текстуры выгружаются (LRU)
+#и загружаются снова из файла при следующем use()
+class TextureCache:
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.textures: OrderedDict[tuple, Material2D] = OrderedDict()
+        self.refs: dict[tuple, int] = {}
+        self.resident = 0
+        self.evictions = 0
+
+    def key(self, filepath, sampler):
+        return (os.path.realpath(filepath), sampler)
+
+    def acquire(self, filepath, loader=None, sampler=DEFAULT_SAMPLER):
+        key = self.key(filepath, sampler)
+        if key in self.textures:
+            self.refs[key] += 1
+            texture = self.textures[key]
+            if self.budget is not None:
+                self.touch(texture)
+            return texture
+
+        texture = Material2D(filepath, 0, loader, sampler)
+        if self.budget is not None:
+            texture.cache = self
+        self.textures[key] = texture
+        self.refs[key] = 1
+        self.resident += texture.size
+        self.trim(texture)
+        return texture
+
+    def release(self, texture):
+        key = self.key(texture.filepath, texture.sampler)
+        self.refs[key] -= 1
+        if self.refs[key] == 0:
+            del self.refs[key]
+            del self.textures[key]
+            if texture.texture is not None:
+                self.resident -= texture.size
             texture.destroy()
 
+    def touch(self, *textures):
+        for texture in textures:
+            if texture.texture is None:
+                texture.reload()
+                self.resident += texture.size
+            self.textures.move_to_end(self.key(texture.filepath, texture.sampler))
+        self.trim(*textures)
+
+    #выгрузка самых старых текстур, пока не уложимся в лимит
+    def trim(self, *keep):
+        if self.budget is None:
+            return
+        for texture in list(self.textures.values()):
+            if self.resident <= self.budget:
+                break
+            if texture.texture is None or any(texture is kept for kept in keep):
+                continue
+            texture.evict()
+            self.resident -= texture.size
+            self.evictions += 1
+
+    def clear(self):
+        for texture in self.textures.values():
+            texture.destroy()
+        self.textures.clear()
+        self.refs.clear()
+        self.resident = 0
+
+#общие материалы по имени, типам файлов и сэмплеру, со счётчиком ссылок
+class MaterialCache:
+    def __init__(self, textureCache):
+        self.textureCache = textureCache
+        self.materials: dict[tuple, Material3D] = {}
+        self.refs: dict[tuple, int] = {}
+        self.keys: dict[int, tuple] = {}
+
+    def acquire(self, filename, filetype, filetypeNRM, loader=None, sampler=DEFAULT_SAMPLER):
+        key = (filename, filetype, filetypeNRM, sampler)
+        if key not in self.materials:
+            material = Material3D(filename, filetype, filetypeNRM, loader, self.textureCache, sampler)
+            self.materials[key] = material
+            self.refs[key] = 0
+            self.keys[id(material)] = key
+        self.refs[key] += 1
+        return self.materials[key]
+
+    def release(self, material):
+        key = self.keys[id(material)]
+        self.refs[key] -= 1
+        if self.refs[key] == 0:
+            del self.refs[key]
+            del self.materials[key]
+            del self.keys[id(material)]
+            material.destroy()
+
+    def clear(self):
+        for material in self.materials.values():
+            material.destroy()
+        self.materials.clear()
+        self.refs.clear()
+        self.keys.clear()
+
+#фоновая загрузка ресурсов: задачи с одинаковыми параметрами выполняются один раз,
+#результат забирается через future.result() в потоке с контекстом opengl
+class AssetLoader:
+    def __init__(self, workers=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+
+    def request(self, key, function, *args):
+        if key not in self.jobs:
+            self.jobs[key] = self.pool.submit(function, *args)
+        return self.jobs[key]
+
+    #результат задачи (с ожиданием); загрузчик его больше не держит, и данные освобождаются,
+    #как только вызывающий загрузит их в opengl. Повторный запрос выполнит задачу заново
+    def take(self, key, function, *args):
+        future = self.request(key, function, *args)
+        del self.jobs[key]
+        return future.result()
+
+    def requestMesh(self, filename, smoothTangents=False, useCache=True, indexed=False, optimizeCache=False):
+        args = (filename, smoothTangents, useCache, indexed, optimizeCache)
+        return self.request(("mesh",) + args, load_obj_mesh_data, *args)
+
+    def takeMesh(self, filename, smoothTangents=False, useCache=True, indexed=False, optimizeCache=False):
+        args = (filename, smoothTangents, useCache, indexed, optimizeCache)
+        return self.take(("mesh",) + args, load_obj_mesh_data, *args)
+
+    def requestImage(self, filepath):
+        return self.request(("image", filepath), decode_image, filepath)
+
+    def takeImage(self, filepath):
+        return self.take(("image", filepath), decode_image, filepath)
+
+    def requestMaterial(self, filename, filetype, filetypeNRM):
+        return [self.requestImage(filepath) for filepath in material_paths(filename, filetype, filetypeNRM)]
+
+    def shutdown(self):
+        self.pool.shutdown()
+        self.jobs.clear()
+
 class Plane:
     def __init__(self, w, h, k):
 
@@ -1017,5 +3268,20 @@ class Plane:
         glDeleteBuffers(1, (self.vbo,))
 
 if __name__ == "__main__":
-    window = initialize_glfw()
-    myApp = App(window)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Interactive scene viewer.")
+    parser.add_argument("--record", default=None, help="save the camera path to this JSON file on exit")
+    parser.add_argument("--fps", type=int, default=FRAME_CAP, help="frame cap, 0 - unlimited")
+    parser.add_argument("--single-buffer", dest="double_buffer", action="store_false", help="draw into the front buffer")
+    parser.add_argument("--swap-interval", type=int, default=SWAP_INTERVAL, help="0 - no vsync, 1 - vsync")
+    parser.add_argument("--frames-in-flight", type=int, default=FRAMES_IN_FLIGHT, help="2 - double, 3 - triple buffering")
+    parser.add_argument("--profile", default=None, help="profile passes and write a Chrome trace JSON here on exit")
+    parser.add_argument("--render-scale", type=float, default=RENDER_SCALE, help="internal resolution relative to the window, e.g. 0.5-2")
+    parser.add_argument("--dynamic-resolution", type=float, default=None, metavar="MS",
+                        help="adjust the render scale to hold this GPU frame time")
+    parser.add_argument("--no-depth-prepass", dest="depth_prepass", action="store_false", help="shade without a depth pre-pass")
+    parser.add_argument("--overdraw", action="store_true", help="show shaded fragments per pixel instead of lighting")
+    args = parser.parse_args()
+
+    window = initialize_glfw(args.double_buffer, args.swap_interval)
+    myApp = App(window, args.record, args.fps, args.double_buffer, args.frames_in_flight, args.profile,
+                args.render_scale, args.dynamic_resolution, args.depth_prepass, args.overdraw)
\ No newline at end of file
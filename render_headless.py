@@ -0,0 +1,127 @@
+import argparse
+import ctypes
+import os
+import time
+
+#платформа PyOpenGL выбирается до первого импорта OpenGL (в том числе через main)
+def select_platform(platform):
+    os.environ["PYOPENGL_PLATFORM"] = platform
+    if platform == "egl":
+        os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+#контекст OpenGL 4.1 core без окна: EGL (без поверхности - всё рисуется в FBO) или OSMesa
+def create_headless_context(platform, width, height):
+    if platform == "egl":
+        from OpenGL import EGL
+
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        if not EGL.eglInitialize(display, None, None):
+            raise RuntimeError("eglInitialize failed")
+        attributes = (EGL.EGLint * 5)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count)) or count.value == 0:
+            raise RuntimeError("no EGL config with desktop OpenGL")
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+
+        contextAttributes = (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 1,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, contextAttributes)
+        if context == EGL.EGL_NO_CONTEXT:
+            raise RuntimeError("eglCreateContext failed")
+        if not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+            raise RuntimeError("eglMakeCurrent failed (EGL_KHR_surfaceless_context required)")
+        return (display, context)
+
+    from OpenGL import GL, arrays, osmesa
+
+    attributes = arrays.GLintArray.asArray([
+        osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA, osmesa.OSMESA_DEPTH_BITS, 24,
+        osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+        osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 4, osmesa.OSMESA_CONTEXT_MINOR_VERSION, 1, 0
+    ])
+    context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+    if not context:
+        raise RuntimeError("OSMesaCreateContextAttribs failed")
+    #буфер OSMesa нужен только для MakeCurrent, кадры рисуются в FBO
+    buffer = arrays.GLubyteArray.zeros((height, width, 4))
+    if not osmesa.OSMesaMakeCurrent(context, buffer, GL.GL_UNSIGNED_BYTE, width, height):
+        raise RuntimeError("OSMesaMakeCurrent failed")
+    return (context, buffer)
+
+def destroy_headless_context(platform, handles):
+    if platform == "egl":
+        from OpenGL import EGL
+        display, context = handles
+        EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(display, context)
+        EGL.eglTerminate(display)
+    else:
+        from OpenGL import osmesa
+        osmesa.OSMesaDestroyContext(handles[0])
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return (int(width), int(height))
+
+def save_frame(outDir, format, frame, pixels):
+    from PIL import Image
+
+    if format == "png":
+        Image.fromarray(pixels, mode="RGBA").save(os.path.join(outDir, f"frame_{frame:05d}.png"))
+    else:
+        with open(os.path.join(outDir, f"frame_{frame:05d}.rgba"), 'wb') as file:
+            file.write(pixels.tobytes())
+
+#рендеринг без окна и без GPU (например Mesa llvmpipe): кадры в FBO, чтение через PBO,
+#камера - по сценарию (файл ключевых кадров CameraPath или облёт сцены)
+def main():
+    parser = argparse.ArgumentParser(description="Render the scene without a window into PNG or raw RGBA frames.")
+    parser.add_argument("--frames", type=int, default=60, help="number of frames to render")
+    parser.add_argument("--size", type=parse_size, default=None, help="frame size WxH (default: window framebuffer size)")
+    parser.add_argument("--out", default="frames", help="output directory")
+    parser.add_argument("--format", choices=("png", "raw"), default="png", help="PNG sequence or raw top-down RGBA8")
+    parser.add_argument("--path", default=None, help="camera path JSON (default: orbit around the scene)")
+    parser.add_argument("--platform", choices=("egl", "osmesa"), default="egl", help="headless OpenGL platform")
+    parser.add_argument("--scale", type=float, default=1.0, help="internal render scale, upscaled to the frame size")
+    parser.add_argument("--no-depth-prepass", dest="depth_prepass", action="store_false", help="shade without a depth pre-pass")
+    parser.add_argument("--overdraw", action="store_true", help="render shaded fragments per pixel instead of lighting")
+    parser.add_argument("--readback", type=int, default=3, help="number of PBOs in flight for glReadPixels")
+    args = parser.parse_args()
+
+    select_platform(args.platform)
+    from main import SCREEN_HEIGHT, SCREEN_WIDTH, CameraPath, FrameReader, GraphicsEngine, OffscreenTarget, Scene
+
+    width, height = args.size or (SCREEN_WIDTH * 2, SCREEN_HEIGHT * 2)
+    handles = create_headless_context(args.platform, width, height)
+    os.makedirs(args.out, exist_ok=True)
+
+    renderer = GraphicsEngine(renderScale=args.scale, depthPrepass=args.depth_prepass)
+    renderer.setDebugOverdraw(args.overdraw)
+    scene = Scene()
+    target = OffscreenTarget(width, height)
+    reader = FrameReader(width, height, args.readback)
+    renderer.setRenderTarget(target.fbo, width, height)
+    path = CameraPath.load(args.path) if args.path else CameraPath.orbit(args.frames)
+
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        path.apply(scene, frame)
+        renderer.render(scene)
+        for tag, pixels in reader.request(target.fbo, frame):
+            save_frame(args.out, args.format, tag, pixels)
+    for tag, pixels in reader.flush():
+        save_frame(args.out, args.format, tag, pixels)
+    elapsed = time.perf_counter() - start
+    print(f"{args.frames} frames {width}x{height} -> {args.out} ({args.format}), {elapsed / max(1, args.frames) * 1000:.1f} ms/frame")
+    if renderer.overdraw is not None:
+        print(f"overdraw: {renderer.overdraw:.2f} shaded fragments per pixel")
+
+    reader.destroy()
+    target.destroy()
+    renderer.quit()
+    destroy_headless_context(args.platform, handles)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+#загрузчик obj
+
+#куб с общими вершинами: квадратные грани (разбиваются веером) и одна треугольная пара
+CUBE_OBJ = """\
+v -1 -1 -1
+v 1 -1 -1
+v 1 1 -1
+v -1 1 -1
+v -1 -1 1
+v 1 -1 1
+v 1 1 1
+v -1 1 1
+vt 0 0
+vt 1 0
+vt 1 1
+vt 0 1
+vn 0 0 -1
+vn 0 0 1
+vn -1 0 0
+vn 1 0 0
+vn 0 -1 0
+vn 0 1 0
+f 1/1/1 4/4/1 3/3/1 2/2/1
+f 5/1/2 6/2/2 7/3/2 8/4/2
+f 1/1/3 5/2/3 8/3/3 4/4/3
+f 2/1/4 3/4/4 7/3/4 6/2/4
+f 1/1/5 2/2/5 6/3/5
+f 1/1/5 6/3/5 5/4/5
+f 4/1/6 8/4/6 7/3/6 3/2/6
+"""
+
+@pytest.fixture
+def cube(tmp_path):
+    filename = tmp_path / "cube.obj"
+    filename.write_text(CUBE_OBJ)
+    return str(filename)
+
+def test_obj_loader_matches_legacy(cube):
+    from bench_objloader import legacy_load_mesh
+
+    legacy = legacy_load_mesh(cube)
+    vertices = main.load_obj_mesh(cube)
+    assert vertices.shape == legacy.shape == (12 * 3 * 14,)
+    assert np.array_equal(vertices, legacy)
+
+#кэш мешей
+
+@pytest.fixture
+def mesh_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MESH_CACHE_DIR", str(tmp_path / "cache"))
+
+def corrupt_index(paths):
+    with open(paths[0], 'w') as file:
+        file.write('{"version": ')
+
+def index_not_a_dict(paths):
+    with open(paths[0], 'w') as file:
+        file.write("[]")
+
+def index_missing_key(paths):
+    with open(paths[0], 'r') as file:
+        entry = json.load(file)
+    del entry["vertex_count"]
+    with open(paths[0], 'w') as file:
+        json.dump(entry, file)
+
+def truncated_blob(paths):
+    with open(paths[1], 'r+b') as file:
+        file.truncate(40)
+
+def short_blob(paths):
+    np.save(paths[1], np.zeros(14, dtype=np.float32))
+
+def truncated_indices(paths):
+    with open(paths[2], 'r+b') as file:
+        file.truncate(140)
+
+@pytest.mark.parametrize("corrupt", [
+    corrupt_index, index_not_a_dict, index_missing_key, truncated_blob, short_blob, truncated_indices])
+def test_corrupt_mesh_cache_is_a_miss(cube, mesh_cache, corrupt):
+    expected = main.load_cached_obj_mesh(cube, indexed=True)
+    paths = main.mesh_cache_paths(cube, "s0i1o0")
+    assert isinstance(main.load_cached_obj_mesh(cube, indexed=True)[0], np.memmap)
+
+    corrupt(paths)
+    vertices, indices = main.load_cached_obj_mesh(cube, indexed=True)
+    assert np.array_equal(vertices, expected[0])
+    assert np.array_equal(indices, expected[1])
+
+    #запись пересобрана - следующая загрузка снова из кэша
+    vertices, indices = main.load_cached_obj_mesh(cube, indexed=True)
+    assert isinstance(vertices, np.memmap)
+    assert np.array_equal(vertices, expected[0])
+
+#индексированные меши
+
+def triangles_of(vertices, indices, stride=14):
+    return vertices.reshape(-1, stride)[np.asarray(indices, dtype=np.int64)].reshape(-1, 3, stride)
+
+def test_index_round_trip(cube):
+    vertices = main.load_obj_mesh(cube)
+    unique, indices = main.index_vertices(vertices)
+    assert indices.dtype == np.uint32
+    assert len(unique) < len(vertices)
+    assert np.array_equal(unique.reshape(-1, 14)[indices], vertices.reshape(-1, 14))
+
+def test_vertex_cache_keeps_triangles(cube):
+    unique, indices = main.index_vertices(main.load_obj_mesh(cube))
+    optimizedVertices, optimized = main.optimize_vertex_cache(unique, indices)
+    assert len(optimized) == len(indices)
+    assert len(optimizedVertices) == len(unique)
+
+    #набор треугольников тот же, с точностью до порядка и поворота углов
+    def canonical(triangles):
+        keys = []
+        for triangle in triangles:
+            corners = [tuple(corner) for corner in triangle]
+            start = corners.index(min(corners))
+            keys.append(tuple(corners[start:] + corners[:start]))
+        return sorted(keys)
+
+    assert canonical(triangles_of(optimizedVertices, optimized)) == canonical(triangles_of(unique, indices))
+
+#запечённые текстуры
+
+@pytest.fixture
+def source_image(tmp_path):
+    filepath = str(tmp_path / "wall_COL.png")
+    Image.new("RGBA", (8, 4), (10, 20, 30, 255)).save(filepath)
+    return filepath
+
+def test_baked_texture_is_read_when_fresh(source_image):
+    from bake_textures import FORMAT_IDS, write_baked
+
+    pixels = np.full((4, 8, 1), 128, dtype=np.float32)
+    bakedPath = main.baked_texture_path(source_image)
+    write_baked(bakedPath, pixels, FORMAT_IDS["R8"])
+    assert not os.path.exists(bakedPath + ".tmp")
+
+    image = main.decode_image(source_image)
+    assert image.format == FORMAT_IDS["R8"]
+    assert [(width, height) for width, height, _ in image.levels] == [(8, 4), (4, 2), (2, 1), (1, 1)]
+
+@pytest.mark.parametrize("contents", [b"BT", b"NOPE" + bytes(20)])
+def test_broken_baked_texture_falls_back_to_source(source_image, contents):
+    with open(main.baked_texture_path(source_image), 'wb') as file:
+        file.write(contents)
+
+    image = main.decode_image(source_image)
+    assert image.format == 0
+    assert image.levels[0][:2] == (8, 4)
+
+def test_truncated_baked_texture_without_source_raises(tmp_path):
+    filepath = str(tmp_path / "wall_PACKED") + main.BAKED_TEXTURE_EXT
+    with open(filepath, 'wb') as file:
+        file.write(main.BAKED_TEXTURE_HEADER.pack(main.BAKED_TEXTURE_MAGIC, main.BAKED_TEXTURE_VERSION, 2, 8, 4, 1))
+        file.write(main.BAKED_TEXTURE_LEVEL.pack(8, 4, 64))
+        file.write(bytes(10))
+
+    with pytest.raises(ValueError):
+        main.decode_image(filepath)
+
+#упакованные текстуры материалов
+
+def write_packed_header(filepath, format, magic=None):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as file:
+        file.write(main.BAKED_TEXTURE_HEADER.pack(
+            magic or main.BAKED_TEXTURE_MAGIC, main.BAKED_TEXTURE_VERSION, format, 4, 4, 1))
+
+def test_material_paths_use_packed_texture(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_packed_header(main.packed_material_path("Wall"), 2)
+
+    paths = main.material_paths("Wall", "jpg", "png")
+    assert paths == ["gfx/Wall/Wall_COL.jpg", main.packed_material_path("Wall"), "gfx/Wall/Wall_NRM.png"]
+
+@pytest.mark.parametrize("contents", [b"", b"BT", None])
+def test_material_paths_fall_back_to_separate_maps(tmp_path, monkeypatch, contents):
+    monkeypatch.chdir(tmp_path)
+    filepath = main.packed_material_path("Wall")
+    if contents is None:
+        write_packed_header(filepath, 2, magic=b"NOPE")
+    else:
+        os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as file:
+            file.write(contents)
+
+    paths = main.material_paths("Wall", "jpg", "png")
+    assert len(paths) == 4
+    assert paths[1] == "gfx/Wall/Wall_AO.jpg"
+
+#каскады теней
+
+def make_camera(position):
+    camera = main.Camera(position)
+    camera.theta = -20
+    camera.phi = 35
+    camera.update()
+    return camera
+
+def test_cascade_transforms_stable_under_small_moves():
+    lightDirection = np.array([-0.3, -1, -0.4], dtype=np.float32)
+    splits = main.cascade_splits(0.1, 40, 3)
+    base = main.cascade_transforms(make_camera([0.3, 2.1, 0.7]), lightDirection, splits, main.SHADOW_MAP_RES)
+    moved = main.cascade_transforms(make_camera([0.3001, 2.1, 0.7001]), lightDirection, splits, main.SHADOW_MAP_RES)
+    far = main.cascade_transforms(make_camera([5.3, 2.1, 0.7]), lightDirection, splits, main.SHADOW_MAP_RES)
+
+    assert base.shape == (3, 4, 4)
+    assert np.array_equal(base, moved)
+    assert not np.array_equal(base, far)
+
+def test_cascade_transforms_contain_frustum():
+    camera = make_camera([1, 2, 3])
+    splits = main.cascade_splits(0.1, 40, 3)
+    transforms = main.cascade_transforms(camera, np.array([0.2, -1, 0.1]), splits, main.SHADOW_MAP_RES)
+
+    #центр каждого участка пирамиды камеры попадает внутрь своего каскада
+    start = 0.1
+    for transform, end in zip(transforms, splits):
+        point = camera.position + camera.forwards / np.linalg.norm(camera.forwards) * (start + end) / 2
+        clip = np.append(point, 1) @ transform
+        assert np.all(np.abs(clip[:3] / clip[3]) <= 1)
+        start = end
+
+#кластеры освещения
+
+def test_spheres_in_clusters_matches_brute_force():
+    grid = (4, 3, 5)
+    mins, maxs = main.cluster_bounds(main.perspective_projection(16 / 9), grid, 0.1, 100)
+    rng = np.random.default_rng(7)
+    centers = np.column_stack((rng.uniform(-20, 20, 40), rng.uniform(-10, 10, 40), rng.uniform(-90, 0, 40)))
+    centers = centers.astype(np.float32)
+    radii = rng.uniform(0.5, 8, 40).astype(np.float32)
+
+    mask = main.spheres_in_clusters(mins, maxs, centers, radii)
+    assert mask.shape == (np.prod(grid), 40)
+
+    gx, gy, gz = grid
+    for k in range(gz):
+        for j in range(gy):
+            for i in range(gx):
+                low = np.array([mins[0][k, 0, i], mins[1][k, j, 0], mins[2][k, 0, 0]])
+                high = np.array([maxs[0][k, 0, i], maxs[1][k, j, 0], maxs[2][k, 0, 0]])
+                nearest = np.clip(centers, low, high)
+                expected = ((centers - nearest) ** 2).sum(axis=1) <= radii ** 2
+                assert np.array_equal(mask[(k * gy + j) * gx + i], expected)
+
+def test_cluster_bounds_cover_grid():
+    mins, maxs = main.cluster_bounds(main.perspective_projection(16 / 9), main.LIGHT_CLUSTER_GRID)
+    gx, gy, gz = main.LIGHT_CLUSTER_GRID
+    assert [m.shape for m in mins] == [(gz, 1, gx), (gz, gy, 1), (gz, 1, 1)]
+    #слои по глубине идут вплотную от ближней до дальней плоскости
+    assert maxs[2][0, 0, 0] == pytest.approx(-main.CAMERA_NEAR)
+    assert mins[2][-1, 0, 0] == pytest.approx(-main.CAMERA_FAR)
+    assert np.allclose(mins[2][:-1], maxs[2][1:])
+
+#сценарий камеры
+
+def test_camera_path_interpolation(tmp_path):
+    path = main.CameraPath([
+        {"frame": 10, "position": [4, 0, 2], "theta": 10, "phi": 270},
+        {"frame": 0, "position": [0, 2, 0], "theta": -10, "phi": 90},
+    ])
+    position, theta, phi = path.pose(5)
+    assert np.allclose(position, [2, 1, 1])
+    assert theta == pytest.approx(0)
+    assert phi == pytest.approx(180)
+
+    #за пределами сценария поза держится на крайнем ключевом кадре
+    position, theta, phi = path.pose(20)
+    assert np.allclose(position, [4, 0, 2]) and theta == 10 and phi == 270
+
+    filename = tmp_path / "path.json"
+    path.save(filename)
+    loaded = main.CameraPath.load(filename)
+    assert np.array_equal(loaded.frames, path.frames)
+    assert np.array_equal(loaded.poses, path.poses)
+
+def test_camera_path_orbit():
+    path = main.CameraPath.orbit(160, radius=10, height=0)
+    assert path.frames[0] == 0 and path.frames[-1] == 160
+    position, theta, phi = path.pose(40)
+    assert np.allclose(position, [0, 0, 10], atol=1e-5)
+    assert phi == pytest.approx(270)
+
+#сравнение прогонов бенчмарка
+
+def p95_summary(**metrics):
+    return {name: {"p95": value} for name, value in metrics.items()}
+
+def test_compare_flags_regressions_above_threshold(capsys):
+    from bench_frames import compare
+
+    baseline = p95_summary(frame_time=10.0, cpu=4.0, gpu_total=6.0)
+    summary = p95_summary(frame_time=11.5, cpu=4.1, gpu_total=6.0, extra=1.0)
+    assert compare(summary, baseline, 10) == ["frame_time"]
+    assert "extra" not in capsys.readouterr().out
+
+def test_compare_skips_metrics_below_floor(capsys):
+    from bench_frames import MIN_COMPARE_MS, compare
+
+    baseline = p95_summary(frame_time=10.0, **{"gpu.upscale": 0.05})
+    summary = p95_summary(frame_time=10.0, **{"gpu.upscale": 0.2})
+    assert compare(summary, baseline, 10) == []
+    assert "(below floor)" in capsys.readouterr().out
+
+    #порог задаётся --min-ms; без него крошечный участок снова проверяется
+    assert MIN_COMPARE_MS == 0.5
+    assert compare(summary, baseline, 10, minMs=0) == ["gpu.upscale"]
+
+#шаг симуляции
+
+def test_frame_clock_steps_and_alpha(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("main.time.perf_counter", lambda: now[0])
+    clock = main.FrameClock(step=0.01, frameCap=0, maxDelta=0.25)
+
+    now[0] += 0.035
+    assert clock.tick() == pytest.approx(0.035)
+    assert clock.steps() == 3
+    assert clock.alpha == pytest.approx(0.5)
+
+    #долгий кадр урезается до maxDelta
+    now[0] += 5
+    assert clock.tick() == pytest.approx(0.25)
+    assert clock.steps() == 25
+    assert clock.alpha == pytest.approx(0.5)
+    assert clock.steps() == 0
+
+#динамическое разрешение
+
+#запросы времени gpu без контекста: результат готов через latency кадров после записи
+class FakeTimestamps:
+    def __init__(self, monkeypatch, latency=1):
+        self.now = 0.0
+        self.frame = 0
+        self.latency = latency
+        self.times = {}
+        self.written = {}
+        self.generated = 0
+        monkeypatch.setattr(main, "glGenQueries", self.generate)
+        monkeypatch.setattr(main, "glQueryCounter", self.counter)
+        monkeypatch.setattr(main, "glGetQueryObjectiv", lambda query, name: self.frame - self.written[query] >= self.latency)
+        monkeypatch.setattr(main, "query_result", lambda query: self.times[query])
+
+    def generate(self, count):
+        self.generated += 1
+        return [self.generated]
+
+    def counter(self, query, target):
+        self.times[query] = int(self.now * 1e6)
+        self.written[query] = self.frame
+
+    #кадр длительностью ms на gpu; возвращает результат update()
+    def frame_ms(self, controller, ms):
+        controller.begin()
+        self.now += ms
+        controller.end()
+        self.frame += 1
+        return controller.update()
+
+def test_resolution_controller_lowers_scale_when_slow(monkeypatch):
+    timer = FakeTimestamps(monkeypatch)
+    controller = main.ResolutionController(10, scale=1.0, interval=3)
+
+    results = [timer.frame_ms(controller, 20) for _ in range(3)]
+    assert results[:2] == [None, None]
+    assert results[2] == pytest.approx(0.7)
+    assert controller.scale == pytest.approx(0.7)
+
+def test_resolution_controller_ignores_frames_from_old_scale(monkeypatch):
+    timer = FakeTimestamps(monkeypatch, latency=3)
+    controller = main.ResolutionController(10, scale=1.0, interval=1)
+
+    results = [timer.frame_ms(controller, 20) for _ in range(3)]
+    assert results == [None, None, pytest.approx(0.7)]
+    assert len(controller.pending) == 2
+
+    #кадры старого масштаба дочитываются, но не двигают масштаб дальше
+    for _ in range(2):
+        assert timer.frame_ms(controller, 10) is None
+        assert controller.gpuMs is None
+    assert timer.frame_ms(controller, 10) is None
+    assert controller.gpuMs == pytest.approx(10)
+    assert controller.scale == pytest.approx(0.7)
+
+#профилировщик
+
+def test_scope_times_sum_same_name_scopes_at_depth():
+    result = {"scopes": [
+        ("frame", 0, 0.0, 0.010, 0.0, 0.012),
+        ("shadow", 1, 0.001, 0.004, 0.001, 0.005),
+        ("cascade0", 2, 0.001, 0.002, 0.001, 0.003),
+        ("lit", 1, 0.005, 0.006, 0.006, 0.008),
+        ("lit", 1, 0.007, 0.009, 0.009, 0.010),
+    ]}
+    times = main.FrameProfiler.scopeTimes(result)
+    assert list(times) == ["shadow", "lit"]
+    assert times["shadow"] == pytest.approx((3.0, 4.0))
+    assert times["lit"] == pytest.approx((3.0, 3.0))
+    assert main.FrameProfiler.scopeTimes(result, depth=2) == {"cascade0": pytest.approx((1.0, 2.0))}
+
+def test_profiler_collects_nested_scopes(monkeypatch):
+    timer = FakeTimestamps(monkeypatch)
+    monkeypatch.setattr(main, "gl_timestamp", lambda: 0)
+    monkeypatch.setattr(main.time, "perf_counter", lambda: timer.now / 1000)
+    profiler = main.FrameProfiler()
+
+    for frame in range(3):
+        profiler.beginFrame()
+        profiler.begin("shadow")
+        timer.now += 2
+        profiler.end()
+        profiler.begin("lit")
+        profiler.begin("Carpet")
+        timer.now += 3
+        profiler.end()
+        profiler.end()
+        profiler.endFrame({"draws": frame})
+        timer.frame += 1
+
+    #кадр читается к концу следующего, последний забирается flush;
+    #третий кадр уже пишет в запросы первого
+    assert len(profiler.results) == 2
+    assert timer.generated == 16
+    profiler.flush()
+    result = profiler.results[-1]
+    assert result["frame"] == 2 and result["counters"] == {"draws": 2}
+    assert main.FrameProfiler.scopeTimes(result) == {"shadow": pytest.approx((2, 2)), "lit": pytest.approx((3, 3))}
+    assert main.FrameProfiler.scopeTimes(result, depth=2) == {"Carpet": pytest.approx((3, 3))}
+
+#очередь отрисовки
+
+def translations(*positions):
+    instances = np.tile(np.eye(4, dtype=np.float32), (len(positions), 1, 1))
+    instances[:, 3, :3] = positions
+    return instances
+
+def test_render_queue_front_to_back():
+    from types import SimpleNamespace
+
+    shader = SimpleNamespace(prog=1)
+    near = SimpleNamespace(boundsCenter=np.array([0, 1, 0], dtype=np.float32), vao=2)
+    far = SimpleNamespace(boundsCenter=np.zeros(3, dtype=np.float32), vao=1)
+    queue = main.RenderQueue()
+    queue.add(shader, None, far, translations([0, 0, -30], [0, 0, -10]))
+    queue.add(shader, None, near, translations([0, 0, 8], [0, 0, -2], [0, 0, 4]))
+
+    items = queue.frontToBack(np.zeros(3, dtype=np.float32))
+    assert [mesh for _, _, mesh, _ in items] == [near, far]
+    assert items[0][3][:, 3, 2].tolist() == [-2, 4, 8]
+    assert items[1][3][:, 3, 2].tolist() == [-10, -30]
+
+    #сортировка по состоянию сохраняет порядок экземпляров
+    items = queue.sorted()
+    assert [mesh for _, _, mesh, _ in items] == [far, near]
+    assert items[1][3][:, 3, 2].tolist() == [-2, 4, 8]
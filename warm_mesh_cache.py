@@ -0,0 +1,31 @@
+import argparse
+import glob
+import time
+
+from main import MESH_CACHE_DIR, load_cached_obj_mesh
+
+#предварительное заполнение кэша мешей, чтобы первый запуск не разбирал obj
+def main():
+    parser = argparse.ArgumentParser(description=f"Pre-warm the binary mesh cache in {MESH_CACHE_DIR}.")
+    parser.add_argument("files", nargs="*", help="obj files (default: models/*.obj)")
+    parser.add_argument("--smooth", action="store_true", help="cache smoothed tangents variant")
+    parser.add_argument("--indexed", action="store_true", help="cache deduplicated vertices and indices")
+    parser.add_argument("--optimize", action="store_true", help="reorder indexed triangles for the vertex cache")
+    args = parser.parse_args()
+
+    for filename in args.files or sorted(glob.glob("models/*.obj")):
+        start = time.perf_counter()
+        vertices, indices = load_cached_obj_mesh(filename, args.smooth, args.indexed, args.optimize)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        vertexCount = len(vertices) // 14
+        if indices is None:
+            print(f"{filename}: {vertexCount} vertices, {vertices.nbytes / 1024:.1f} KiB, {elapsed:.1f} ms")
+        else:
+            before = len(indices) * 56
+            after = vertices.nbytes + indices.nbytes
+            print(f"{filename}: {len(indices)} -> {vertexCount} vertices, "
+                  f"{before / 1024:.1f} -> {after / 1024:.1f} KiB, {elapsed:.1f} ms")
+
+if __name__ == "__main__":
+    main()